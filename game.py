@@ -1,24 +1,55 @@
+import os
 import pygame
 import math
 import sys
+import json
+import time
+import zlib
+import zipfile
+import hashlib
 import random
+import tempfile
+import argparse
+import platform
+import threading
+import multiprocessing
+import functools
+import itertools
 import numpy as np
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
 from pygame import mixer
 
-# Initialize pygame and mixer
-pygame.init()
-mixer.init()
-
 # Constants
 WIDTH, HEIGHT = 800, 600
 HALF_HEIGHT = HEIGHT // 2
 FOV = 60  # Field of view
 HALF_FOV = FOV / 2
-RAY_COUNT = 120  # Number of rays to cast
+RAY_COUNT = WIDTH  # Number of rays to cast (one per screen column) at full resolution
 MAX_DEPTH = 800  # Maximum ray casting distance
 TILE_SIZE = 64
 PLAYER_SIZE = 10
 SCALE = WIDTH / RAY_COUNT
+COLUMN_CACHE_BYTES = 16 * 1024 * 1024  # Memory cap for cached wall strips (0 disables the cache)
+RENDER_THREADS = 0  # Threads for the wall pass, split into vertical bands (0 or 1 for none)
+
+# Dynamic resolution: the number of rays cast (the horizontal internal
+# resolution) follows the measured frame cost, between MIN_RAY_COUNT and
+# RAY_COUNT; each ray's column is stretched across the screen width
+DYNAMIC_RESOLUTION = True
+MIN_RAY_COUNT = WIDTH // 4
+FRAME_BUDGET_MS = 12.0  # Target frame cost, leaving headroom in a 60 FPS frame
+ray_count = RAY_COUNT  # Rays cast this frame
+
+# Present only the parts of the screen that changed since the last frame
+# (nothing when the view is still, the HUD strip when only the HUD changed)
+DIRTY_RECTS = True
+
+# Map streaming: the level is split into CHUNK_SIZE tile chunks and only
+# those within CHUNK_RADIUS chunks of the player's are active (see ChunkManager)
+CHUNK_SIZE = 32
+CHUNK_RADIUS = math.ceil(max(MAX_DEPTH, TILE_SIZE * 8) / (CHUNK_SIZE * TILE_SIZE))
 
 # Colors
 WHITE = (255, 255, 255)
@@ -31,8 +62,9 @@ DARK_GRAY = (50, 50, 50)
 BROWN = (150, 75, 0)
 YELLOW = (255, 255, 0)
 
-# Game map (1 = wall, 0 = empty space, 2 = door, 3 = health pack, 4 = ammo)
-MAP = [
+# Game map (1 = wall, 0 = empty space, 2 = door, 3 = health pack, 4 = ammo),
+# one uint8 per tile indexed as MAP[y, x]. set_level() swaps in a loaded level.
+MAP = np.array([
     [1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1],
     [1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1],
     [1, 0, 0, 0, 3, 0, 0, 0, 0, 0, 1, 0, 0, 3, 0, 1],
@@ -49,87 +81,386 @@ MAP = [
     [1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 1],
     [1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1],
     [1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1]
-]
+], dtype=np.uint8)
+
+MAP_WIDTH = MAP.shape[1] * TILE_SIZE
+MAP_HEIGHT = MAP.shape[0] * TILE_SIZE
+PLAYER_START = (TILE_SIZE * 1.5, TILE_SIZE * 1.5, 0)  # x, y, angle
+
+# Lookup table of map items that stop a ray (wall or closed door)
+SOLID_CELLS = np.zeros(256, dtype=bool)
+SOLID_CELLS[[1, 2]] = True
+
+# Level files: a fixed-size little-endian header, the map as height rows of
+# width uint8 tiles, then spawn_count enemy spawns as float32 (x, y) pairs.
+# Positions are in tiles. Hand-made levels can also mark a spawn in the grid
+# with tile 5, which is cleared to empty space on load; files written by
+# save_level keep every spawn in the table and set LEVEL_TABLE_SPAWNS in
+# flags, so loading them never scans the grid. A level can end with its
+# precomputed PVS table: PVS_HEADER, then the arrays of a PvsTable in
+# PVS_ARRAYS order.
+LEVEL_MAGIC = b"DMAP"
+LEVEL_VERSION = 1
+LEVEL_TABLE_SPAWNS = 1  # Flag: the grid has no spawn tiles
+LEVEL_HEADER = np.dtype([
+    ("magic", "S4"), ("version", "<u2"), ("flags", "<u2"),
+    ("width", "<u4"), ("height", "<u4"),
+    ("start_x", "<f4"), ("start_y", "<f4"), ("start_angle", "<f4"), ("spawn_count", "<u4"),
+])
+ENEMY_SPAWN_TILE = 5
+
+# A loaded level: the tile grid, player start (x, y, angle), enemy spawns
+# and its PvsTable (None to build one from the grid when it is played)
+Level = namedtuple("Level", ["grid", "start", "spawns", "pvs"], defaults=(None,))
+
+# Write a level file; start and spawns are in world units like PLAYER_START
+# and ENEMY_SPAWNS. A PvsTable for the grid is stored with it, built in full
+# first if it was being built on demand.
+def save_level(path, grid, start, spawns=(), pvs=None):
+    grid = np.asarray(grid, dtype=np.uint8)
+    spawn_table = np.array(spawns, dtype="<f4").reshape(-1, 2) / TILE_SIZE
+
+    # Spawns marked in the grid move to the table
+    spawn_y, spawn_x = np.nonzero(grid == ENEMY_SPAWN_TILE)
+    if spawn_x.size:
+        grid = np.where(grid == ENEMY_SPAWN_TILE, 0, grid).astype(np.uint8)
+        spawn_table = np.concatenate([spawn_table, np.column_stack([spawn_x + 0.5, spawn_y + 0.5])]).astype("<f4")
+
+    header = np.zeros(1, dtype=LEVEL_HEADER)
+    header["magic"] = LEVEL_MAGIC
+    header["version"] = LEVEL_VERSION
+    header["flags"] = LEVEL_TABLE_SPAWNS
+    header["height"], header["width"] = grid.shape
+    header["start_x"] = start[0] / TILE_SIZE
+    header["start_y"] = start[1] / TILE_SIZE
+    header["start_angle"] = start[2]
+    header["spawn_count"] = len(spawn_table)
+    with open(path, "wb") as f:
+        header.tofile(f)
+        grid.tofile(f)
+        spawn_table.tofile(f)
+        if pvs is not None:
+            if not pvs.complete:
+                pvs.build_all()
+            pvs_header = np.zeros(1, dtype=PVS_HEADER)
+            pvs_header["magic"] = PVS_MAGIC
+            pvs_header["radius"] = pvs.radius
+            pvs_header["door_slots"] = PVS_MAX_DOORS
+            pvs_header["mask_bytes"] = pvs.mask_bytes
+            pvs_header["open_count"] = len(pvs.open_masks)
+            pvs_header["group_count"] = len(pvs.group_doors)
+            pvs_header["cell_count"] = len(pvs.cells)
+            pvs_header.tofile(f)
+            for name, dtype in PVS_ARRAYS:
+                getattr(pvs, name).astype(dtype).tofile(f)
+
+# Read a level file. With mmap the grid is memory-mapped copy-on-write, so
+# only the pages the game touches are read and changes never reach the file;
+# the PvsTable reads the walls through a second, read-only map of the same
+# pages rather than a copy.
+def load_level(path, mmap=True):
+    header = np.fromfile(path, dtype=LEVEL_HEADER, count=1)
+    if header.size == 0 or header["magic"][0] != LEVEL_MAGIC:
+        raise ValueError(f"{path} is not a level file")
+    if header["version"][0] != LEVEL_VERSION:
+        raise ValueError(f"{path} has unsupported level version {header['version'][0]}")
+
+    shape = (int(header["height"][0]), int(header["width"][0]))
+    spawn_count = int(header["spawn_count"][0])
+    spawn_offset = LEVEL_HEADER.itemsize + shape[0] * shape[1]
+    if os.path.getsize(path) < spawn_offset + spawn_count * 8:
+        raise ValueError(f"{path} is truncated")
+    if mmap:
+        grid = np.memmap(path, dtype=np.uint8, mode="c", offset=LEVEL_HEADER.itemsize, shape=shape)
+        walls = np.memmap(path, dtype=np.uint8, mode="r", offset=LEVEL_HEADER.itemsize, shape=shape)
+    else:
+        grid = np.fromfile(path, dtype=np.uint8, count=shape[0] * shape[1],
+                           offset=LEVEL_HEADER.itemsize).reshape(shape)
+        walls = grid.copy()
+
+    spawn_table = np.fromfile(path, dtype="<f4", count=spawn_count * 2, offset=spawn_offset).reshape(-1, 2)
+    spawns = [(x * TILE_SIZE, y * TILE_SIZE) for x, y in spawn_table.astype(np.float64).tolist()]
+    pvs = load_pvs(path, walls, spawn_offset + spawn_count * 8, mmap)
+
+    # Spawns marked in the grid of a hand-made level
+    if not header["flags"][0] & LEVEL_TABLE_SPAWNS:
+        spawn_y, spawn_x = np.nonzero(grid == ENEMY_SPAWN_TILE)
+        grid[spawn_y, spawn_x] = 0
+        spawns += [((x + 0.5) * TILE_SIZE, (y + 0.5) * TILE_SIZE)
+                   for x, y in zip(spawn_x.tolist(), spawn_y.tolist())]
+    start = (float(header["start_x"][0]) * TILE_SIZE, float(header["start_y"][0]) * TILE_SIZE,
+             float(header["start_angle"][0]))
+    return Level(grid, start, spawns, pvs)
+
+# Read the PVS table stored at offset in a level file, memory-mapped like the
+# grid. Without one, or with one built with other PVS settings, the table
+# starts empty and builds its tiles on demand.
+def load_pvs(path, grid, offset, mmap=True):
+    if os.path.getsize(path) <= offset:
+        return PvsTable(grid)
+    header = np.fromfile(path, dtype=PVS_HEADER, count=1, offset=offset)
+    if header.size == 0 or header["magic"][0] != PVS_MAGIC:
+        raise ValueError(f"{path} has a damaged PVS table")
+    if header["radius"][0] != pvs_radius(grid.shape) or header["door_slots"][0] != PVS_MAX_DOORS:
+        return PvsTable(grid)
+
+    groups = int(header["group_count"][0])
+    shapes = [(grid.size,), (int(header["open_count"][0]), int(header["mask_bytes"][0])), (grid.size + 1,),
+              (groups, PVS_MAX_DOORS), (groups + 1,), (int(header["cell_count"][0]),)]
+    offset += PVS_HEADER.itemsize
+    sizes = [np.dtype(dtype).itemsize * math.prod(shape) for (_, dtype), shape in zip(PVS_ARRAYS, shapes)]
+    if os.path.getsize(path) < offset + sum(sizes):
+        raise ValueError(f"{path} is truncated")
+    arrays = {}
+    for (name, dtype), shape, size in zip(PVS_ARRAYS, shapes, sizes):
+        if mmap:
+            arrays[name] = np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=shape)
+        else:
+            arrays[name] = np.fromfile(path, dtype=dtype, count=math.prod(shape), offset=offset).reshape(shape)
+        offset += size
+    return PvsTable(grid, arrays)
+
+# The screen and clock are created by init_display()
+screen = None
+clock = None
+
+# Initialize pygame, audio and the game window
+def init_display():
+    global screen, clock
+    pygame.init()
+    try:
+        mixer.init()
+    except pygame.error:
+        pass  # No audio device, sounds are skipped
+    screen = pygame.display.set_mode((WIDTH, HEIGHT))
+    pygame.display.set_caption("DOOM Clone")
+    clock = pygame.time.Clock()
+
+# Assets are built on first use by the functions registered below and then
+# kept for the rest of the run. With a cache directory (DOOM_ASSET_CACHE or
+# --asset-cache), generated surfaces and arrays are also saved to disk and
+# loaded from there on the next start. preload() loads them all on a
+# background thread while the start menu runs; report records how long each
+# took, where it came from ("cache", "built", "fallback" or "failed") and why
+# it fell back.
+ASSET_CACHE_VERSION = 1
+
+# Raised by an asset builder that had to settle for a placeholder
+class AssetFallback(Exception):
+    def __init__(self, asset, reason):
+        super().__init__(reason)
+        self.asset = asset
+        self.reason = reason
+
+class AssetManager:
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self.builders = {}
+        self.loaded = {}
+        self.report = {}  # name -> {"seconds", "source", "reason"}
+        self.lock = threading.RLock()  # Builders may load other assets
+        self.preloader = None
+
+    def register(self, name, cacheable=True):
+        def decorator(builder):
+            self.builders[name] = (builder, cacheable)
+            return builder
+        return decorator
+
+    def __getitem__(self, name):
+        asset = self.loaded.get(name)
+        if asset is None:
+            with self.lock:
+                asset = self.loaded.get(name)
+                if asset is None:
+                    asset = self.load(name)
+                    self.loaded[name] = asset
+        return asset
+
+    def load(self, name):
+        builder, cacheable = self.builders[name]
+        start = time.perf_counter()
+        asset, source, reason = None, "built", None
+        path = self.cache_path(name) if cacheable else None
+        if path and os.path.exists(path):
+            try:
+                asset, source = self.read_cache(path), "cache"
+            except (OSError, EOFError, ValueError, KeyError, zipfile.BadZipFile, pygame.error) as error:
+                reason = f"damaged cache entry, rebuilt ({error})"
+        if asset is None:
+            try:
+                asset = builder()
+            except AssetFallback as fallback:
+                asset, source, reason = fallback.asset, "fallback", fallback.reason
+            else:
+                if path:
+                    self.write_cache(path, asset)
+        self.report[name] = {"seconds": time.perf_counter() - start, "source": source, "reason": reason}
+        return asset
+
+    # Start loading every registered asset on a background thread
+    def preload(self):
+        if self.preloader is None:
+            self.preloader = threading.Thread(target=self.preload_all, name="assets", daemon=True)
+            self.preloader.start()
+
+    def preload_all(self):
+        for name in list(self.builders):
+            try:
+                self[name]
+            except pygame.error as error:
+                # Left unloaded; using it raises the error again
+                self.report[name] = {"seconds": 0.0, "source": "failed", "reason": str(error)}
+
+    # Assets loaded (or failed) so far, and the total
+    def progress(self):
+        return len(self.report), len(self.builders)
+
+    def cache_path(self, name):
+        if not self.cache_dir:
+            return None
+        return os.path.join(self.cache_dir, f"{name}-v{ASSET_CACHE_VERSION}-{TILE_SIZE}-{WIDTH}x{HEIGHT}.npz")
 
-MAP_WIDTH = len(MAP[0]) * TILE_SIZE
-MAP_HEIGHT = len(MAP) * TILE_SIZE
+    def read_cache(self, path):
+        with np.load(path) as cached:
+            if str(cached["kind"]) == "surface":
+                size = tuple(int(n) for n in cached["size"])
+                return pygame.image.frombytes(cached["data"].tobytes(), size, str(cached["format"]))
+            return cached["data"]
 
-# Create the screen
-screen = pygame.display.set_mode((WIDTH, HEIGHT))
-pygame.display.set_caption("DOOM Clone")
-clock = pygame.time.Clock()
+    def write_cache(self, path, asset):
+        if isinstance(asset, pygame.Surface):
+            image_format = "RGBA" if asset.get_flags() & pygame.SRCALPHA else "RGB"
+            data = np.frombuffer(pygame.image.tobytes(asset, image_format), dtype=np.uint8)
+            fields = {"kind": "surface", "format": image_format, "size": asset.get_size(), "data": data}
+        else:
+            fields = {"kind": "array", "data": asset}
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            with open(temp_path, "wb") as f:
+                np.savez(f, **fields)
+            os.replace(temp_path, path)
+        except OSError:
+            pass  # Cache directory not writable, keep the asset in memory only
+
+assets = AssetManager(os.environ.get("DOOM_ASSET_CACHE"))
 
 # Load and create textures
 def create_texture(color, pattern=True):
-    texture = pygame.Surface((TILE_SIZE, TILE_SIZE))
-    texture.fill(color)
+    pixels = np.empty((TILE_SIZE, TILE_SIZE, 3), dtype=np.uint8)
+    pixels[:] = color
     if pattern:
-        for i in range(TILE_SIZE):
-            for j in range(TILE_SIZE):
-                if (i + j) % 8 == 0 or i % 8 == 0 or j % 8 == 0:
-                    texture.set_at((i, j), (max(0, color[0] - 50), max(0, color[1] - 50), max(0, color[2] - 50)))
-    return texture
+        i, j = np.indices((TILE_SIZE, TILE_SIZE))
+        lines = ((i + j) % 8 == 0) | (i % 8 == 0) | (j % 8 == 0)
+        pixels[lines] = (max(0, color[0] - 50), max(0, color[1] - 50), max(0, color[2] - 50))
+    return pygame.surfarray.make_surface(pixels)
+
+assets.register("wall_texture")(lambda: create_texture(BROWN))
+assets.register("door_texture")(lambda: create_texture((100, 50, 0)))
+assets.register("health_texture")(lambda: create_texture((200, 0, 0), False))
+assets.register("ammo_texture")(lambda: create_texture((200, 200, 0), False))
+
+# Wall textures by id, and the texture id for each map item
+WALL_TEXTURES = ("wall_texture", "door_texture")
+WALL_TEXTURE_IDS = np.zeros(256, dtype=np.int32)
+WALL_TEXTURE_IDS[2] = 1
 
-wall_texture = create_texture(BROWN)
-door_texture = create_texture((100, 50, 0))
-health_texture = create_texture((200, 0, 0), False)
-ammo_texture = create_texture((200, 200, 0), False)
+# Flat palette for the framebuffer wall renderer: every texel of every wall
+# texture in plain and shadowed form, followed by the sky and floor colors.
+# Texel index = ((texture id * 2 + shade) * TILE_SIZE + column) * TILE_SIZE + row
+SKY_INDEX = len(WALL_TEXTURES) * 2 * TILE_SIZE * TILE_SIZE
+FLOOR_INDEX = SKY_INDEX + 1
+
+@assets.register("wall_palette")
+def build_wall_palette():
+    texels = np.empty((len(WALL_TEXTURES), 2, TILE_SIZE, TILE_SIZE, 3), dtype=np.uint8)
+    for tex_id, name in enumerate(WALL_TEXTURES):
+        pixels = pygame.surfarray.array3d(assets[name])
+        texels[tex_id, 0] = pixels
+        texels[tex_id, 1] = pixels.astype(np.uint16) * 205 // 255  # Shadow for vertical hits
+    sky_floor = np.array([(50, 50, 100), (50, 50, 50)], dtype=np.uint8)
+    return np.concatenate((texels.reshape(-1, 3), sky_floor))
 
 # Create enemy sprite
-enemy_texture = pygame.Surface((TILE_SIZE, TILE_SIZE))
-enemy_texture.fill((0, 0, 0, 0))
-pygame.draw.circle(enemy_texture, (200, 20, 20), (TILE_SIZE // 2, TILE_SIZE // 2), TILE_SIZE // 3)
-pygame.draw.circle(enemy_texture, (50, 50, 50), (TILE_SIZE // 2, TILE_SIZE // 2), TILE_SIZE // 4)
+@assets.register("enemy_texture")
+def create_enemy_texture():
+    enemy_texture = pygame.Surface((TILE_SIZE, TILE_SIZE))
+    enemy_texture.fill((0, 0, 0, 0))
+    pygame.draw.circle(enemy_texture, (200, 20, 20), (TILE_SIZE // 2, TILE_SIZE // 2), TILE_SIZE // 3)
+    pygame.draw.circle(enemy_texture, (50, 50, 50), (TILE_SIZE // 2, TILE_SIZE // 2), TILE_SIZE // 4)
+    return enemy_texture
 
 # Create weapon images
-shotgun_image = pygame.Surface((300, 200), pygame.SRCALPHA)
-pygame.draw.rect(shotgun_image, (60, 60, 60), (80, 100, 180, 20))  # barrel
-pygame.draw.rect(shotgun_image, (80, 80, 80), (70, 120, 60, 60))   # handle
-shotgun_image = pygame.transform.scale(shotgun_image, (WIDTH // 2, HEIGHT // 2))
-
-pistol_image = pygame.Surface((200, 150), pygame.SRCALPHA)
-pygame.draw.rect(pistol_image, (50, 50, 50), (80, 80, 100, 15))  # barrel
-pygame.draw.rect(pistol_image, (70, 70, 70), (70, 95, 40, 50))   # handle
-pistol_image = pygame.transform.scale(pistol_image, (WIDTH // 3, HEIGHT // 3))
-
-bfg_image = pygame.Surface((400, 250), pygame.SRCALPHA)
-pygame.draw.rect(bfg_image, (20, 100, 20), (100, 100, 200, 40))  # barrel
-pygame.draw.rect(bfg_image, (50, 150, 50), (80, 140, 80, 70))    # handle
-pygame.draw.circle(bfg_image, (0, 255, 0, 128), (300, 120), 30)  # energy orb
-bfg_image = pygame.transform.scale(bfg_image, (WIDTH // 2, HEIGHT // 2))
+@assets.register("shotgun_image")
+def create_shotgun_image():
+    shotgun_image = pygame.Surface((300, 200), pygame.SRCALPHA)
+    pygame.draw.rect(shotgun_image, (60, 60, 60), (80, 100, 180, 20))  # barrel
+    pygame.draw.rect(shotgun_image, (80, 80, 80), (70, 120, 60, 60))   # handle
+    return pygame.transform.scale(shotgun_image, (WIDTH // 2, HEIGHT // 2))
+
+@assets.register("pistol_image")
+def create_pistol_image():
+    pistol_image = pygame.Surface((200, 150), pygame.SRCALPHA)
+    pygame.draw.rect(pistol_image, (50, 50, 50), (80, 80, 100, 15))  # barrel
+    pygame.draw.rect(pistol_image, (70, 70, 70), (70, 95, 40, 50))   # handle
+    return pygame.transform.scale(pistol_image, (WIDTH // 3, HEIGHT // 3))
+
+@assets.register("bfg_image")
+def create_bfg_image():
+    bfg_image = pygame.Surface((400, 250), pygame.SRCALPHA)
+    pygame.draw.rect(bfg_image, (20, 100, 20), (100, 100, 200, 40))  # barrel
+    pygame.draw.rect(bfg_image, (50, 150, 50), (80, 140, 80, 70))    # handle
+    pygame.draw.circle(bfg_image, (0, 255, 0, 128), (300, 120), 30)  # energy orb
+    return pygame.transform.scale(bfg_image, (WIDTH // 2, HEIGHT // 2))
 
 # Create muzzle flash
-muzzle_flash = pygame.Surface((100, 100), pygame.SRCALPHA)
-pygame.draw.circle(muzzle_flash, (255, 255, 0, 200), (50, 50), 40)
-pygame.draw.circle(muzzle_flash, (255, 150, 0, 150), (50, 50), 30)
-pygame.draw.circle(muzzle_flash, (255, 255, 255, 100), (50, 50), 20)
+@assets.register("muzzle_flash")
+def create_muzzle_flash():
+    muzzle_flash = pygame.Surface((100, 100), pygame.SRCALPHA)
+    pygame.draw.circle(muzzle_flash, (255, 255, 0, 200), (50, 50), 40)
+    pygame.draw.circle(muzzle_flash, (255, 150, 0, 150), (50, 50), 30)
+    pygame.draw.circle(muzzle_flash, (255, 255, 255, 100), (50, 50), 20)
+    return muzzle_flash
 
 # Create HUD elements
-hud_font = pygame.font.SysFont('Arial', 24)
-
-# Load sounds
-try:
-    shotgun_sound = mixer.Sound("shotgun.wav")
-    pistol_sound = mixer.Sound("pistol.wav") 
-    bfg_sound = mixer.Sound("bfg.wav")
-    pain_sound = mixer.Sound("pain.wav")
-    death_sound = mixer.Sound("death.wav")
-    pickup_sound = mixer.Sound("pickup.wav")
-    door_sound = mixer.Sound("door.wav")
-except:
-    # Create placeholder sounds if files not found
-    shotgun_sound = mixer.Sound(buffer=bytes([128] * 2048))
-    pistol_sound = mixer.Sound(buffer=bytes([128] * 1024))
-    bfg_sound = mixer.Sound(buffer=bytes([128] * 4096))
-    pain_sound = mixer.Sound(buffer=bytes([128] * 1024))
-    death_sound = mixer.Sound(buffer=bytes([128] * 2048))
-    pickup_sound = mixer.Sound(buffer=bytes([128] * 512))
-    door_sound = mixer.Sound(buffer=bytes([128] * 1024))
+@assets.register("hud_font", cacheable=False)
+def create_hud_font():
+    if not pygame.font.get_init():
+        pygame.font.init()
+    return pygame.font.SysFont('Arial', 24)
+
+# Load sounds, with a silent placeholder if the file is missing
+SOUND_FILES = {
+    "shotgun_sound": ("shotgun.wav", 2048),
+    "pistol_sound": ("pistol.wav", 1024),
+    "bfg_sound": ("bfg.wav", 4096),
+    "pain_sound": ("pain.wav", 1024),
+    "death_sound": ("death.wav", 2048),
+    "pickup_sound": ("pickup.wav", 512),
+    "door_sound": ("door.wav", 1024),
+}
+
+def load_sound(filename, placeholder_size):
+    try:
+        return mixer.Sound(filename)
+    except (pygame.error, FileNotFoundError) as error:
+        raise AssetFallback(mixer.Sound(buffer=bytes([128] * placeholder_size)), f"{filename}: {error}")
+
+for sound_name, (sound_file, placeholder_size) in SOUND_FILES.items():
+    assets.register(sound_name, cacheable=False)(functools.partial(load_sound, sound_file, placeholder_size))
+
+# Play a sound if audio is available
+def play_sound(name):
+    if not mixer.get_init():
+        return  # No mixer (no audio device, or a headless simulation)
+    try:
+        assets[name].play()
+    except pygame.error:
+        pass
 
 # Player setup
-player_x = TILE_SIZE * 1.5
-player_y = TILE_SIZE * 1.5
-player_angle = 0
+player_x, player_y, player_angle = PLAYER_START
 player_speed = 3
 rotation_speed = 3
 player_health = 100
@@ -142,86 +473,791 @@ is_firing = False
 firing_frame = 0
 door_opening = {}  # Track doors that are opening/closing
 
+# Gameplay randomness (weapon spread) comes from here, never the global
+# random module, so a session seeded the same way replays exactly
+rng = random.Random()
+
 # Enemy setup
-class Enemy:
-    def __init__(self, x, y, health=100):
-        self.x = x
-        self.y = y
-        self.health = health
-        self.angle = 0
-        self.speed = 1
-        self.state = "idle"  # idle, chase, attack
-        self.attack_cooldown = 0
-        self.hit_cooldown = 0
-        self.dead = False
-        
-    def update(self, player_x, player_y):
-        if self.dead:
-            return
-            
-        # Calculate distance to player
-        dx = player_x - self.x
-        dy = player_y - self.y
-        distance = math.sqrt(dx*dx + dy*dy)
-        
-        # Calculate angle to player
-        self.angle = math.degrees(math.atan2(dy, dx))
-        
-        if self.hit_cooldown > 0:
-            self.hit_cooldown -= 1
-            return
-            
-        # State machine
-        if distance < TILE_SIZE * 1.5:
-            self.state = "attack"
-            if self.attack_cooldown <= 0:
-                # Attack player
-                self.attack_cooldown = 60  # Attack once per second
-                return True
-            else:
-                self.attack_cooldown -= 1
-        elif distance < TILE_SIZE * 8:
-            self.state = "chase"
-            # Move towards player if not blocked by wall
-            move_x = self.x + math.cos(math.radians(self.angle)) * self.speed
-            move_y = self.y + math.sin(math.radians(self.angle)) * self.speed
-            if not is_wall(move_x, move_y):
-                self.x = move_x
-                self.y = move_y
+ENEMY_STATES = ("idle", "chase", "attack")
+IDLE, CHASE, ATTACK = range(3)
+ENEMY_SPAWNS = [
+    (TILE_SIZE * 8.5, TILE_SIZE * 2.5),
+    (TILE_SIZE * 14.5, TILE_SIZE * 8.5),
+    (TILE_SIZE * 12.5, TILE_SIZE * 13.5),
+    (TILE_SIZE * 3.5, TILE_SIZE * 9.5),
+    (TILE_SIZE * 9.5, TILE_SIZE * 14.5)
+]
+
+# The built-in level as it is before anyone plays on it
+BUILTIN_LEVEL = Level(MAP.copy(), PLAYER_START, list(ENEMY_SPAWNS))
+
+# Uniform grid of enemy indices keyed on map tile (or on chunk)
+class SpatialHash:
+    def __init__(self):
+        self.cells = {}  # (map_x, map_y) -> set of enemy indices
+
+    def insert(self, index, tile):
+        self.cells.setdefault(tile, set()).add(index)
+
+    def remove(self, index, tile):
+        cell = self.cells.get(tile)
+        if cell is not None:
+            cell.discard(index)
+            if not cell:
+                del self.cells[tile]
+
+    def move(self, index, old_tile, new_tile):
+        self.remove(index, old_tile)
+        self.insert(index, new_tile)
+
+    # Indices of all enemies in the given tiles
+    def query(self, tiles_x, tiles_y):
+        found = []
+        for tile in zip(tiles_x.tolist(), tiles_y.tolist()):
+            cell = self.cells.get(tile)
+            if cell:
+                found.extend(cell)
+        return found
+
+# Map tiles that may overlap the cone from (x, y) towards angle, half_angle
+# degrees wide on each side and max_distance long. Tiles are tested as
+# circles around their centers, so the result errs on the side of more tiles
+def cone_tiles(x, y, angle, half_angle, max_distance):
+    rows, cols = MAP.shape
+    reach = max_distance / TILE_SIZE
+    origin_x = x / TILE_SIZE
+    origin_y = y / TILE_SIZE
+
+    # Bounding box of the apex, the arc ends and any axis extremes on the arc
+    edge_angles = [angle - half_angle, angle + half_angle]
+    edge_angles += [a for a in (0, 90, 180, 270) if abs((a - angle + 180) % 360 - 180) <= half_angle]
+    points_x = [origin_x] + [origin_x + math.cos(to_radians(a)) * reach for a in edge_angles]
+    points_y = [origin_y] + [origin_y + math.sin(to_radians(a)) * reach for a in edge_angles]
+    first_x, last_x = max(0, math.floor(min(points_x))), min(cols - 1, math.floor(max(points_x)))
+    first_y, last_y = max(0, math.floor(min(points_y))), min(rows - 1, math.floor(max(points_y)))
+    if first_x > last_x or first_y > last_y:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    tiles_x, tiles_y = np.meshgrid(np.arange(first_x, last_x + 1), np.arange(first_y, last_y + 1))
+    dx = tiles_x + 0.5 - origin_x
+    dy = tiles_y + 0.5 - origin_y
+    distance = np.sqrt(dx*dx + dy*dy)
+    half_diagonal = math.sqrt(0.5)
+
+    # Angular half-width of each tile as seen from the apex
+    rel_angle = (np.degrees(np.arctan2(dy, dx)) - angle + 180) % 360 - 180
+    with np.errstate(divide='ignore'):
+        widen = np.degrees(np.arcsin(np.minimum(half_diagonal / distance, 1)))
+    widen[distance <= half_diagonal] = 180
+
+    inside = (distance <= reach + half_diagonal) & (np.abs(rel_angle) <= half_angle + widen)
+    return tiles_x[inside], tiles_y[inside]
+
+# All enemies, stored as parallel NumPy arrays so they update in one batch
+class EnemyStore:
+    def __init__(self, positions=(), health=100):
+        count = len(positions)
+        positions = np.array(positions, dtype=np.float64).reshape(count, 2)
+        self.x = positions[:, 0].copy()
+        self.y = positions[:, 1].copy()
+        self.health = np.full(count, health, dtype=np.int64)
+        self.angle = np.zeros(count)
+        self.speed = np.ones(count)
+        self.state = np.full(count, IDLE, dtype=np.int8)
+        self.attack_cooldown = np.zeros(count, dtype=np.int64)
+        self.hit_cooldown = np.zeros(count, dtype=np.int64)
+        self.dead = np.zeros(count, dtype=bool)
+        self.awake = np.zeros(count, dtype=bool)  # Set once the enemy might have seen the player
+
+        # Positions at the start of the last update, for interpolated rendering
+        self.prev_x = self.x.copy()
+        self.prev_y = self.y.copy()
+
+        # Spatial hashes of living enemies by map tile and by chunk
+        self.tile_x = (self.x // TILE_SIZE).astype(np.int64)
+        self.tile_y = (self.y // TILE_SIZE).astype(np.int64)
+        self.grid = SpatialHash()
+        self.chunks = SpatialHash()
+        for index, (tile_x, tile_y) in enumerate(zip(self.tile_x.tolist(), self.tile_y.tolist())):
+            self.grid.insert(index, (tile_x, tile_y))
+            self.chunks.insert(index, (tile_x // CHUNK_SIZE, tile_y // CHUNK_SIZE))
+
+    def __len__(self):
+        return len(self.x)
+
+    def __getitem__(self, index):
+        return Enemy(self, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield Enemy(self, index)
+
+    # Update all living enemies (or only those in indices) for one frame and
+    # return how many of them attacked the player. Chasers follow the flow
+    # field if one is given, else they head straight for the player. The
+    # player position can also be given per enemy, as arrays like self.x.
+    def update(self, player_x, player_y, indices=None, flow=None):
+        if indices is None:
+            self.prev_x[:] = self.x
+            self.prev_y[:] = self.y
+            alive = np.nonzero(~self.dead)[0]
         else:
-            self.state = "idle"
-            
-        return False
-        
-    def take_damage(self, damage):
-        if self.dead:
+            self.prev_x[indices] = self.x[indices]
+            self.prev_y[indices] = self.y[indices]
+            alive = indices[~self.dead[indices]]
+
+        # Calculate distance and angle to player
+        if np.ndim(player_x):
+            player_x, player_y = player_x[alive], player_y[alive]
+        dx = player_x - self.x[alive]
+        dy = player_y - self.y[alive]
+        distance = np.sqrt(dx*dx + dy*dy)
+        angle = np.degrees(np.arctan2(dy, dx))
+        self.angle[alive] = angle
+
+        # Enemies that were just hit skip this frame
+        stunned = self.hit_cooldown[alive] > 0
+        self.hit_cooldown[alive[stunned]] -= 1
+        active = alive[~stunned]
+        distance = distance[~stunned]
+        angle = angle[~stunned]
+
+        # State machine
+        attacking = distance < TILE_SIZE * 1.5
+        chasing = ~attacking & (distance < TILE_SIZE * 8)
+        self.state[active] = np.where(attacking, ATTACK, np.where(chasing, CHASE, IDLE))
+
+        # Attack player once the cooldown has run out (once per second)
+        attackers = active[attacking]
+        ready = self.attack_cooldown[attackers] <= 0
+        self.attack_cooldown[attackers[ready]] = 60
+        self.attack_cooldown[attackers[~ready]] -= 1
+
+        # Move towards player if not blocked by wall
+        chasers = active[chasing]
+        chase_angle = np.radians(angle[chasing])
+        if flow is not None and chasers.size:
+            # Head for the centre of the next tile on the path where there is one
+            next_x, next_y, on_path = self.next_tiles(chasers, flow)
+            path_angle = np.arctan2((next_y + 0.5) * TILE_SIZE - self.y[chasers],
+                                    (next_x + 0.5) * TILE_SIZE - self.x[chasers])
+            chase_angle = np.where(on_path, path_angle, chase_angle)
+        move_x = self.x[chasers] + np.cos(chase_angle) * self.speed[chasers]
+        move_y = self.y[chasers] + np.sin(chase_angle) * self.speed[chasers]
+        free = ~self.walls(chasers, move_x, move_y)
+        movers = chasers[free]
+        self.x[movers] = move_x[free]
+        self.y[movers] = move_y[free]
+
+        # Re-file enemies that crossed into another tile
+        tile_x = (self.x[movers] // TILE_SIZE).astype(np.int64)
+        tile_y = (self.y[movers] // TILE_SIZE).astype(np.int64)
+        crossed = (tile_x != self.tile_x[movers]) | (tile_y != self.tile_y[movers])
+        for index, new_x, new_y in zip(movers[crossed].tolist(), tile_x[crossed].tolist(), tile_y[crossed].tolist()):
+            self.refile(index, (int(self.tile_x[index]), int(self.tile_y[index])), (new_x, new_y))
+        self.tile_x[movers] = tile_x
+        self.tile_y[movers] = tile_y
+
+        return self.attacks(attackers[ready])
+
+    # The parts of update() that depend on the map, which an EnemyBatch
+    # looks up in each enemy's own world: whether points are in walls, the
+    # flow field's next tiles, the spatial hashes and the attack count
+    def walls(self, indices, xs, ys):
+        return is_wall_array(xs, ys)
+
+    def next_tiles(self, indices, flow):
+        return flow.next_tiles(self.tile_x[indices], self.tile_y[indices])
+
+    def refile(self, index, old_tile, new_tile):
+        self.grid.move(index, old_tile, new_tile)
+        old_chunk = (old_tile[0] // CHUNK_SIZE, old_tile[1] // CHUNK_SIZE)
+        new_chunk = (new_tile[0] // CHUNK_SIZE, new_tile[1] // CHUNK_SIZE)
+        if old_chunk != new_chunk:
+            self.chunks.move(index, old_chunk, new_chunk)
+
+    def attacks(self, attackers):
+        return len(attackers)
+
+    # Positions blended between the last two updates (alpha 0 = previous)
+    def interpolate(self, alpha):
+        if alpha >= 1:
+            return self.x, self.y
+        return self.prev_x + (self.x - self.prev_x) * alpha, self.prev_y + (self.y - self.prev_y) * alpha
+
+    # Living enemies in the tiles a cone from (x, y) may overlap, in index
+    # order, with their distance and angle relative to the cone axis
+    def query_cone(self, x, y, angle, half_angle, max_distance):
+        tiles_x, tiles_y = cone_tiles(x, y, angle, half_angle, max_distance)
+        indices = np.array(sorted(self.grid.query(tiles_x, tiles_y)), dtype=np.int64)
+        dx = self.x[indices] - x
+        dy = self.y[indices] - y
+        distance = np.sqrt(dx*dx + dy*dy)
+        rel_angle = (np.degrees(np.arctan2(dy, dx)) - angle) % 360
+        rel_angle = np.where(rel_angle > 180, rel_angle - 360, rel_angle)
+        return indices, distance, rel_angle
+
+    # Living enemies in the given chunks, in index order
+    def in_chunks(self, chunks_x, chunks_y):
+        return np.array(sorted(self.chunks.query(chunks_x, chunks_y)), dtype=np.int64)
+
+    def take_damage(self, index, damage):
+        if self.dead[index]:
             return False
-            
-        self.health -= damage
-        self.hit_cooldown = 5  # Short invulnerability
-        
-        if self.health <= 0:
-            self.dead = True
-            try:
-                death_sound.play()
-            except:
-                pass
+
+        self.health[index] -= damage
+        self.hit_cooldown[index] = 5  # Short invulnerability
+        self.awake[index] = True
+
+        if self.health[index] <= 0:
+            self.dead[index] = True
+            tile_x, tile_y = int(self.tile_x[index]), int(self.tile_y[index])
+            self.grid.remove(index, (tile_x, tile_y))
+            self.chunks.remove(index, (tile_x // CHUNK_SIZE, tile_y // CHUNK_SIZE))
+            play_sound("death_sound")
             return True
         else:
-            try:
-                pain_sound.play()
-            except:
-                pass
+            play_sound("pain_sound")
             return False
 
+# A single enemy, as a view into an EnemyStore
+class Enemy:
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    @property
+    def x(self):
+        return float(self.store.x[self.index])
+
+    @property
+    def y(self):
+        return float(self.store.y[self.index])
+
+    @property
+    def health(self):
+        return int(self.store.health[self.index])
+
+    @property
+    def angle(self):
+        return float(self.store.angle[self.index])
+
+    @property
+    def state(self):
+        return ENEMY_STATES[self.store.state[self.index]]
+
+    @property
+    def dead(self):
+        return bool(self.store.dead[self.index])
+
+    @property
+    def awake(self):
+        return bool(self.store.awake[self.index])
+
+    def update(self, player_x, player_y):
+        return self.store.update(player_x, player_y, np.array([self.index])) > 0
+
+    def take_damage(self, damage):
+        return self.store.take_damage(self.index, damage)
+
 # Create enemies
-enemies = [
-    Enemy(TILE_SIZE * 8.5, TILE_SIZE * 2.5),
-    Enemy(TILE_SIZE * 14.5, TILE_SIZE * 8.5),
-    Enemy(TILE_SIZE * 12.5, TILE_SIZE * 13.5),
-    Enemy(TILE_SIZE * 3.5, TILE_SIZE * 9.5),
-    Enemy(TILE_SIZE * 9.5, TILE_SIZE * 14.5)
-]
+enemies = EnemyStore(ENEMY_SPAWNS)
+
+# The world is split into square chunks of CHUNK_SIZE tiles. Only the chunks
+# within CHUNK_RADIUS of the player's chunk are active: rays stop at the edge
+# of the active window and enemies outside it are frozen, so per-tick work
+# depends on the area around the player rather than on the level size. The
+# radius is chosen so the window reaches past MAX_DEPTH and the enemy chase
+# range in every direction.
+class ChunkManager:
+    def __init__(self, chunk_size=CHUNK_SIZE, radius=CHUNK_RADIUS):
+        self.chunk_size = chunk_size
+        self.radius = radius
+        self.center = None  # Chunk the player is in
+        self.chunks_x = np.empty(0, dtype=np.int64)  # Active chunks
+        self.chunks_y = np.empty(0, dtype=np.int64)
+        self.bounds = (0, 0, 0, 0)  # Active tiles as (first_x, first_y, end_x, end_y)
+
+    # Re-centre the active window when the player enters another chunk;
+    # returns True if it moved. shape is the (rows, cols) of the map, MAP's
+    # by default.
+    def update(self, x, y, shape=None):
+        center = (int(x // TILE_SIZE) // self.chunk_size, int(y // TILE_SIZE) // self.chunk_size)
+        if center == self.center:
+            return False
+        self.center = center
+
+        rows, cols = shape or MAP.shape
+        last_x = (cols - 1) // self.chunk_size
+        last_y = (rows - 1) // self.chunk_size
+        first_chunk_x = min(max(center[0] - self.radius, 0), last_x)
+        first_chunk_y = min(max(center[1] - self.radius, 0), last_y)
+        end_chunk_x = max(min(center[0] + self.radius, last_x), first_chunk_x) + 1
+        end_chunk_y = max(min(center[1] + self.radius, last_y), first_chunk_y) + 1
+        chunks_x, chunks_y = np.meshgrid(np.arange(first_chunk_x, end_chunk_x), np.arange(first_chunk_y, end_chunk_y))
+        self.chunks_x = chunks_x.ravel()
+        self.chunks_y = chunks_y.ravel()
+        self.bounds = (first_chunk_x * self.chunk_size, first_chunk_y * self.chunk_size,
+                       min(end_chunk_x * self.chunk_size, cols), min(end_chunk_y * self.chunk_size, rows))
+        return True
+
+    # Forget the window, e.g. after the map changed size
+    def reset(self):
+        self.center = None
+
+    # Living enemies in the active chunks
+    def active_enemies(self, store):
+        return store.in_chunks(self.chunks_x, self.chunks_y)
+
+chunks = ChunkManager()
+chunks.update(player_x, player_y)
+
+# Potentially visible sets: for each tile, the tiles that can be seen from
+# somewhere inside it. A tile's set is built by casting rays from
+# PVS_SAMPLES points in it with doors treated as see-through. Tiles a ray
+# only reaches through doors are filed under the doors it crossed, so the
+# set follows doors opening and closing without a rebuild.
+PVS_RANGE = (CHUNK_RADIUS + 1) * CHUNK_SIZE  # Tiles; as far as the renderer's rays can reach
+PVS_MAX_DOORS = 4  # Doors tracked per ray; doors past these are assumed open
+PVS_SAMPLES = ((0.05, 0.05), (0.95, 0.05), (0.05, 0.95), (0.95, 0.95), (0.5, 0.5))
+PVS_BATCH_TILES = 16  # Tiles traced together when building a whole table
+PVS_CACHE_TILES = 1024  # Tiles kept by a table that builds them on demand
+PVS_EXPORT_TILES = 64 * 64  # Largest level --with-pvs stores a table for (up to ~30 ms and ~2 KB per tile)
+PVS_VISIBLE_TILES = 32  # Recent tiles whose set with the doors as they are is kept
+PVS_MAGIC = b"DPVS"
+PVS_HEADER = np.dtype([
+    ("magic", "S4"), ("radius", "<u4"), ("door_slots", "<u4"), ("mask_bytes", "<u4"),
+    ("open_count", "<u8"), ("group_count", "<u8"), ("cell_count", "<u8"),
+])
+# The arrays of a complete PvsTable in the order and types they are stored in
+PVS_ARRAYS = (("open_rows", "<i8"), ("open_masks", "u1"), ("group_index", "<i8"),
+              ("group_doors", "<i4"), ("cell_index", "<i8"), ("cells", "<u2"))
+
+# The door-independent part of a level's PVS, over the window of tiles
+# within radius of each tile. The tiles reached without crossing a door are
+# most of a set, so they are kept as a packed bitmask per tile (open_masks,
+# row open_rows[tile], -1 for solid tiles). Each group of tiles reached
+# through the same doors is small, so groups[group_index[tile]:
+# group_index[tile + 1]] keep their doors (-1 padded rows of group_doors)
+# and their window offsets (cells[cell_index[group]:cell_index[group + 1]]).
+# It depends only on where walls and doors are, so all copies of a level
+# share one, and grid must not change under it: pass a copy of a map that
+# is played on, or a read-only map of the level file. A level can carry a complete table built offline (see
+# save_level); otherwise nothing is built up front. A tile is built the first
+# time it is queried, its neighbours are built ahead on a background thread
+# (see prefetch), and the most recent PVS_CACHE_TILES are kept.
+class PvsTable:
+    def __init__(self, grid, arrays=None):
+        self.grid = grid
+        self.radius = pvs_radius(grid.shape)
+        self.side = 2 * self.radius + 1  # Window offsets fit in cells' uint16 while PVS_RANGE < 128
+        self.mask_bytes = (self.side * self.side + 7) // 8
+        self.complete = arrays is not None
+        for name, _ in PVS_ARRAYS:
+            setattr(self, name, arrays[name] if self.complete else None)
+        self.built = OrderedDict()  # tile -> groups(), while the table is not complete
+        self.pending = {}  # tile -> Future of its background build
+        self.lock = threading.Lock()  # Guards built and pending against the builder thread
+
+    # Pickled (for WorldPool workers) without the tiles built so far
+    def __getstate__(self):
+        state = dict(self.__dict__, built=OrderedDict(), pending={})
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state, lock=threading.Lock())
+
+    # Flat indices of the door cells, sorted; found on first use
+    @functools.cached_property
+    def doors(self):
+        return np.flatnonzero(self.grid == 2)
+
+    # A tile's door-free bitmask (None for solid tiles), its groups' door
+    # rows and the bounds of their window offsets in cells
+    def groups(self, tile_x, tile_y):
+        tile = tile_y * self.grid.shape[1] + tile_x
+        if self.complete:
+            row = self.open_rows[tile]
+            first, end = self.group_index[tile], self.group_index[tile + 1]
+            return (self.open_masks[row] if row >= 0 else None, self.group_doors[first:end],
+                    self.cell_index[first:end + 1], self.cells)
+        with self.lock:
+            future = self.pending.get(tile)
+        if future is not None and not future.cancel():
+            future.result()  # Already being built ahead; a build still queued is cancelled and done here
+        with self.lock:
+            entry = self.built.get(tile)
+            if entry is not None:
+                self.built.move_to_end(tile)
+                return entry
+        return self.build_entries([tile])[0]
+
+    # Queue these tiles (flat indices) for the background builder, skipping
+    # solid ones and any already built or on the way
+    def prefetch(self, tiles):
+        if self.complete:
+            return
+        with self.lock:
+            for tile in tiles:
+                cell = self.grid.flat[tile]
+                if (not SOLID_CELLS[cell] or cell == 2) and tile not in self.built and tile not in self.pending:
+                    self.pending[tile] = pvs_builder().submit(self.build_entries, [tile])
+
+    # Build tiles (flat indices) and keep them; returns their groups()
+    def build_entries(self, tiles):
+        masks, counts, doors, cell_counts, cells = self.build_tiles(np.array(tiles))
+        group_bounds = np.concatenate([[0], np.cumsum(counts)]).tolist()
+        cell_bounds = np.concatenate([[0], np.cumsum(cell_counts)])
+        entries = []
+        for i, tile in enumerate(tiles):
+            first, end = group_bounds[i], group_bounds[i + 1]
+            bounds = cell_bounds[first:end + 1]
+            entries.append((masks[i], doors[first:end], bounds - bounds[0], cells[bounds[0]:bounds[-1]]))
+        with self.lock:
+            for tile, entry in zip(tiles, entries):
+                self.built[tile] = entry
+                self.built.move_to_end(tile)
+                self.pending.pop(tile, None)
+            while len(self.built) > PVS_CACHE_TILES:
+                self.built.popitem(last=False)
+        return entries
+
+    # Build the table for every tile
+    def build_all(self):
+        open_tiles = np.flatnonzero(~SOLID_CELLS[self.grid] | (self.grid == 2))
+        group_counts = np.zeros(self.grid.size, dtype=np.int64)
+        masks, doors, cell_counts, cells = [], [], [], []
+        for first in range(0, len(open_tiles), PVS_BATCH_TILES):
+            tiles = open_tiles[first:first + PVS_BATCH_TILES]
+            batch = self.build_tiles(tiles)
+            group_counts[tiles] = batch[1]
+            for parts, part in zip((masks, doors, cell_counts, cells), batch[:1] + batch[2:]):
+                parts.append(part)
+        self.open_rows = np.full(self.grid.size, -1, dtype=np.int64)
+        self.open_rows[open_tiles] = np.arange(len(open_tiles))
+        self.open_masks = np.concatenate([np.empty((0, self.mask_bytes), dtype=np.uint8)] + masks)
+        self.group_index = np.concatenate([[0], np.cumsum(group_counts)])
+        self.group_doors = np.concatenate([np.empty((0, PVS_MAX_DOORS), dtype=np.int32)] + doors)
+        self.cell_index = np.concatenate([[0], np.cumsum(np.concatenate([np.empty(0, dtype=np.int64)] + cell_counts))])
+        self.cells = np.concatenate([np.empty(0, dtype=np.uint16)] + cells)
+        self.complete = True
+        with self.lock:
+            self.built.clear()
+
+    # Trace the rays of a batch of tiles (flat indices) and group the tiles
+    # they reach by tile and doors crossed. Every group is grown by one tile,
+    # which covers the gaps between rays and sprites that straddle a tile
+    # edge. Returns each tile's packed door-free mask and door group count,
+    # then the door groups' door rows, offset counts and offsets, in tile
+    # order.
+    def build_tiles(self, tiles):
+        rows, cols = self.grid.shape
+        radius, side = self.radius, self.side
+        tile_x, tile_y = tiles % cols, tiles // cols
+        reach = min(PVS_RANGE, math.hypot(rows, cols))
+        rays = max(360, int(4 * math.pi * reach))  # Under half a tile apart at full reach
+        angles = np.arange(rays) * (2 * math.pi / rays)
+        samples_x, samples_y = np.array(PVS_SAMPLES).T
+        per_tile = rays * len(PVS_SAMPLES)
+        fans = len(PVS_SAMPLES) * len(tiles)
+
+        # Nothing outside the tiles' windows is kept, so rays are traced in
+        # that area of the grid only and stop at its edge
+        first_x, first_y = max(int(tile_x.min()) - radius, 0), max(int(tile_y.min()) - radius, 0)
+        area = self.grid[first_y:int(tile_y.max()) + radius + 1, first_x:int(tile_x.max()) + radius + 1]
+        area_cols = area.shape[1]
+        cells, doors, ray = trace_cells(area,
+                                        np.repeat(tile_x - first_x, per_tile) +
+                                        np.tile(np.repeat(samples_x, rays), len(tiles)),
+                                        np.repeat(tile_y - first_y, per_tile) +
+                                        np.tile(np.repeat(samples_y, rays), len(tiles)),
+                                        np.tile(np.cos(angles), fans), np.tile(np.sin(angles), fans),
+                                        int(reach * 2) + 1)
+
+        # Position of every cell in its tile's window; cells out of reach go
+        owner = ray // per_tile
+        window_x = cells % area_cols + first_x - tile_x[owner] + radius
+        window_y = cells // area_cols + first_y - tile_y[owner] + radius
+        near = (window_x >= 0) & (window_x < side) & (window_y >= 0) & (window_y < side)
+        owner, doors, offsets = owner[near], doors[near], (window_y * side + window_x)[near]
+        doors = np.where(doors >= 0, (doors // area_cols + first_y) * cols + doors % area_cols + first_x, -1)
+
+        # One group per tile for the cells reached without crossing a door,
+        # then one per tile and set of doors crossed
+        via_door = doors[:, 0] >= 0
+        door_keys, door_groups = np.unique(np.column_stack([owner[via_door], np.sort(doors[via_door], axis=1)]),
+                                           axis=0, return_inverse=True)
+        group_owner = np.concatenate([np.arange(len(tiles)), door_keys[:, 0]])
+        masks = np.zeros((len(group_owner), side, side), dtype=bool)
+        masks.reshape(len(group_owner), -1)[np.concatenate([owner[~via_door], len(tiles) + door_groups.ravel()]),
+                                            np.concatenate([offsets[~via_door], offsets[via_door]])] = True
+
+        # Grow by one tile, then clip to the map
+        grown = masks.copy()
+        for shift_y, shift_x in ((0, 1), (0, -1), (1, 0), (-1, 0), (1, 1), (1, -1), (-1, 1), (-1, -1)):
+            grown[:, max(shift_y, 0):side + min(shift_y, 0), max(shift_x, 0):side + min(shift_x, 0)] |= \
+                masks[:, max(-shift_y, 0):side + min(-shift_y, 0), max(-shift_x, 0):side + min(-shift_x, 0)]
+        map_x = tile_x[group_owner, None] - radius + np.arange(side)
+        map_y = tile_y[group_owner, None] - radius + np.arange(side)
+        grown &= ((map_y >= 0) & (map_y < rows))[:, :, None] & ((map_x >= 0) & (map_x < cols))[:, None, :]
+        grown = grown.reshape(len(group_owner), -1)
+
+        # Door groups as window offsets, each tile's together
+        door_grown = grown[len(tiles):]
+        keep = np.flatnonzero(door_grown.any(axis=1))
+        keep = keep[np.argsort(door_keys[keep, 0], kind="stable")]
+        group_rows, offsets = np.nonzero(door_grown[keep])
+        return (np.packbits(grown[:len(tiles)], axis=1), np.bincount(door_keys[keep, 0], minlength=len(tiles)),
+                door_keys[keep, 1:].astype(np.int32), np.bincount(group_rows, minlength=len(keep)),
+                offsets.astype(np.uint16))
+
+# Tiles from a tile to the edge of its PVS window on a map of this shape
+def pvs_radius(shape):
+    return min(PVS_RANGE, max(shape) - 1)
+
+# Thread that builds PVS tiles ahead of the player, created on first use
+pvs_pool = None
+
+def pvs_builder():
+    global pvs_pool
+    if pvs_pool is None:
+        pvs_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pvs")
+    return pvs_pool
+
+# Per-map PVS queries: the level's PvsTable plus the sets of recently
+# visited tiles with the doors as they are in this map
+class PotentiallyVisibleSet:
+    def __init__(self, table=None):
+        self.table = table if table is not None else PvsTable(MAP.copy())
+        self.visible = OrderedDict()  # tile -> window, most recent last
+
+    # Tiles potentially visible from a tile with the doors as they are now,
+    # as a boolean (side, side) window of the table centred on the tile
+    def query(self, tile_x, tile_y):
+        tile = (tile_x, tile_y)
+        result = self.visible.get(tile)
+        if result is not None:
+            self.visible.move_to_end(tile)
+            return result
+
+        result = self.visible[tile] = visible_windows(self.table, tile_x, tile_y, MAP.reshape(1, -1), [0])[0]
+        if len(self.visible) > PVS_VISIBLE_TILES:
+            self.visible.popitem(last=False)
+
+        # The player can only step into a neighbour next
+        rows, cols = MAP.shape
+        self.table.prefetch([(tile_y + dy) * cols + tile_x + dx for dx, dy in FLOW_STEPS
+                             if 0 <= tile_x + dx < cols and 0 <= tile_y + dy < rows])
+        return result
+
+    # Which of the tiles (coordinate arrays) are potentially visible from a tile
+    def contains(self, tile_x, tile_y, tiles_x, tiles_y):
+        window = self.query(tile_x, tile_y)
+        window_x = tiles_x - tile_x + self.table.radius
+        window_y = tiles_y - tile_y + self.table.radius
+        side = self.table.side
+        seen = (window_x >= 0) & (window_x < side) & (window_y >= 0) & (window_y < side)
+        seen[seen] = window[window_y[seen], window_x[seen]]
+        return seen
+
+    # Forget the door-dependent results when a door opens or closes
+    def map_changed(self, map_x, map_y):
+        if self.table.grid[map_y, map_x] == 2:
+            self.visible.clear()
+
+# PotentiallyVisibleSet.query() for one tile in several copies of the
+# table's level, which differ only in the doors: grids holds the copies
+# flattened to rows, and worlds picks the rows to use. Returns a boolean
+# (worlds, side, side) stack of windows.
+def visible_windows(table, tile_x, tile_y, grids, worlds):
+    mask, doors, bounds, cells = table.groups(tile_x, tile_y)
+    side = table.side
+    windows = np.zeros((len(worlds), side * side), dtype=bool)
+    if mask is not None:
+        windows[:] = np.unpackbits(mask, count=side * side).astype(bool)
+
+    # Add the groups behind open doors only
+    worlds = np.asarray(worlds, dtype=np.int64)
+    closed = ((doors >= 0) & (grids[worlds[:, None, None], np.maximum(doors, 0)] == 2)).any(axis=2)
+    group = np.repeat(np.arange(len(doors)), np.diff(bounds))
+    world, cell = np.nonzero(~closed[:, group])
+    windows[world, cells[bounds[0]:bounds[-1]][cell]] = True
+    return windows.reshape(-1, side, side)
+
+# Walk rays (origin in tiles, unit direction) through a grid for up to
+# max_steps grid lines, passing through door cells (2). Returns the flat
+# index of every cell entered, with the doors crossed before it as a row of
+# up to PVS_MAX_DOORS flat indices (-1 for none) and the index of the ray.
+def trace_cells(grid, origin_x, origin_y, dir_x, dir_y, max_steps):
+    rows, cols = grid.shape
+    grid_cells = grid.reshape(-1)
+    step_x = np.where(dir_x > 0, 1, -1)
+    step_y = np.where(dir_y > 0, 1, -1)
+    cell_x = np.floor(origin_x).astype(np.int64)
+    cell_y = np.floor(origin_y).astype(np.int64)
+
+    # Axis-aligned rays never cross the other axis' grid lines; 0 * inf on a
+    # grid line is replaced right after
+    with np.errstate(divide='ignore', invalid='ignore'):
+        delta_x = np.abs(1 / dir_x)
+        delta_y = np.abs(1 / dir_y)
+        side_x = np.where(dir_x > 0, cell_x + 1 - origin_x, origin_x - cell_x) * delta_x
+        side_y = np.where(dir_y > 0, cell_y + 1 - origin_y, origin_y - cell_y) * delta_y
+    side_x[np.isinf(delta_x)] = np.inf
+    side_y[np.isinf(delta_y)] = np.inf
+    crossed = np.full((len(cell_x), PVS_MAX_DOORS), -1, dtype=np.int64)
+    ray = np.arange(len(cell_x))
+
+    seen_cells = [cell_y * cols + cell_x]
+    seen_doors = [crossed]
+    seen_rays = [ray]
+    for _ in range(max_steps):
+        if cell_x.size == 0:
+            break
+
+        # Step every ray to its next grid line
+        along_x = side_x < side_y
+        side_x = np.where(along_x, side_x + delta_x, side_x)
+        side_y = np.where(along_x, side_y, side_y + delta_y)
+        cell_x = cell_x + np.where(along_x, step_x, 0)
+        cell_y = cell_y + np.where(along_x, 0, step_y)
+
+        # Rays leaving the map stop
+        inside = (cell_x >= 0) & (cell_x < cols) & (cell_y >= 0) & (cell_y < rows)
+        flat = np.where(inside, cell_y * cols + cell_x, 0)
+        seen_cells.append(flat[inside])
+        seen_doors.append(crossed[inside])
+        seen_rays.append(ray[inside])
+
+        # Doors are see-through but remembered; walls stop the ray
+        cell = grid_cells[flat]
+        is_door = inside & (cell == 2)
+        if is_door.any():
+            door_rays = np.nonzero(is_door)[0]
+            free = crossed[door_rays] < 0
+            has_free = free.any(axis=1)
+            crossed = crossed.copy()
+            crossed[door_rays[has_free], free[has_free].argmax(axis=1)] = flat[door_rays[has_free]]
+        keep = inside & (~SOLID_CELLS[cell] | is_door)
+        delta_x, delta_y, step_x, step_y = delta_x[keep], delta_y[keep], step_x[keep], step_y[keep]
+        side_x, side_y, cell_x, cell_y = side_x[keep], side_y[keep], cell_x[keep], cell_y[keep]
+        crossed, ray = crossed[keep], ray[keep]
+
+    return np.concatenate(seen_cells), np.concatenate(seen_doors), np.concatenate(seen_rays)
+
+pvs = PotentiallyVisibleSet()
+BUILTIN_LEVEL = BUILTIN_LEVEL._replace(pvs=pvs.table)
+
+# Flow field: the BFS step distance from the player's tile to every tile
+# reachable within FLOW_RADIUS tiles of it, and for each tile the neighbour
+# one step closer. Built once per player tile (and again when a door in range
+# toggles) and shared by every chasing enemy.
+FLOW_RADIUS = 12  # Enemy chase range plus room for detours
+FLOW_STEPS = ((1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (1, -1), (-1, 1), (-1, -1))
+
+class FlowField:
+    def __init__(self, radius=FLOW_RADIUS):
+        self.radius = radius
+        self.origin = None  # Player tile the field was built for
+        self.dirty = True
+        self.bounds = (0, 0, 0, 0)  # Tiles covered as (first_x, first_y, end_x, end_y)
+        self.distance = np.zeros((0, 0), dtype=np.int32)  # -1 where unreachable
+        self.next_x = np.zeros((0, 0), dtype=np.int64)
+        self.next_y = np.zeros((0, 0), dtype=np.int64)
+
+    # Rebuild the field if the player changed tiles or a door in range
+    # toggled; returns True if it was rebuilt
+    def update(self, tile_x, tile_y):
+        if (tile_x, tile_y) == self.origin and not self.dirty:
+            return False
+        self.origin = (tile_x, tile_y)
+        self.dirty = False
+
+        rows, cols = MAP.shape
+        first_x, first_y = max(tile_x - self.radius, 0), max(tile_y - self.radius, 0)
+        end_x, end_y = min(tile_x + self.radius + 1, cols), min(tile_y + self.radius + 1, rows)
+        self.bounds = (first_x, first_y, end_x, end_y)
+        passable = ~SOLID_CELLS[MAP[first_y:end_y, first_x:end_x]]
+        distance, step_x, step_y = flow_search(passable[None], [tile_x - first_x], [tile_y - first_y])
+        self.distance = distance[0]
+        grid_y, grid_x = np.mgrid[first_y:end_y, first_x:end_x]
+        self.next_x = grid_x + step_x[0]
+        self.next_y = grid_y + step_y[0]
+        return True
+
+    # Mark the field stale when a tile in range changes
+    def map_changed(self, map_x, map_y):
+        first_x, first_y, end_x, end_y = self.bounds
+        if first_x <= map_x < end_x and first_y <= map_y < end_y:
+            self.dirty = True
+
+    # Next tile on the path to the player from each tile, and whether the
+    # tile is on a path at all (in range, reachable and not the player's tile)
+    def next_tiles(self, tiles_x, tiles_y):
+        first_x, first_y, end_x, end_y = self.bounds
+        inside = (tiles_x >= first_x) & (tiles_x < end_x) & (tiles_y >= first_y) & (tiles_y < end_y)
+        local_x = np.where(inside, tiles_x - first_x, 0)
+        local_y = np.where(inside, tiles_y - first_y, 0)
+        if not self.distance.size:
+            return tiles_x, tiles_y, np.zeros(len(tiles_x), dtype=bool)
+        on_path = inside & (self.distance[local_y, local_x] > 0)
+        return self.next_x[local_y, local_x], self.next_y[local_y, local_x], on_path
+
+flow_field = FlowField()
+
+# Breadth-first search over a (fields, height, width) stack of passable
+# grids from one start tile per field, one ring of tiles per step. Returns
+# the step distance to every tile (-1 where unreachable) and the step
+# (dx, dy) from each tile to its neighbour with the lowest distance.
+def flow_search(passable, start_x, start_y):
+    count, height, width = passable.shape
+    start_x = np.asarray(start_x, dtype=np.int64)
+    start_y = np.asarray(start_y, dtype=np.int64)
+    distance = np.full(passable.shape, -1, dtype=np.int32)
+    frontier = np.zeros(passable.shape, dtype=bool)
+    inside = (start_x >= 0) & (start_x < width) & (start_y >= 0) & (start_y < height)
+    frontier[np.flatnonzero(inside), start_y[inside], start_x[inside]] = True
+    distance[frontier] = 0
+    step = 0
+    while frontier.any():
+        step += 1
+        grown = np.zeros_like(frontier)
+        grown[:, 1:, :] |= frontier[:, :-1, :]
+        grown[:, :-1, :] |= frontier[:, 1:, :]
+        grown[:, :, 1:] |= frontier[:, :, :-1]
+        grown[:, :, :-1] |= frontier[:, :, 1:]
+        frontier = grown & passable & (distance < 0)
+        distance[frontier] = step
+
+    # Step to the neighbour with the lowest distance. Diagonal steps need
+    # both tiles beside them to be open, so enemies do not cut corners.
+    edge = ((0, 0), (1, 1), (1, 1))
+    padded = np.pad(np.where(distance >= 0, distance, np.iinfo(np.int32).max), edge,
+                    constant_values=np.iinfo(np.int32).max)
+    reachable = np.pad(distance >= 0, edge)
+    best = padded[:, 1:-1, 1:-1].copy()
+    step_x = np.zeros(distance.shape, dtype=np.int64)
+    step_y = np.zeros(distance.shape, dtype=np.int64)
+    for dx, dy in FLOW_STEPS:
+        neighbour = padded[:, 1 + dy:1 + dy + height, 1 + dx:1 + dx + width]
+        better = neighbour < best
+        if dx and dy:
+            better &= reachable[:, 1:-1, 1 + dx:1 + dx + width] & reachable[:, 1 + dy:1 + dy + height, 1:-1]
+        best = np.where(better, neighbour, best)
+        step_x[better] = dx
+        step_y[better] = dy
+    return distance, step_x, step_y
+
+# Wake the enemies that might see the player, then update the awake ones in
+# the active chunks along the flow field; returns how many attacked
+def update_enemies(x, y):
+    chunks.update(x, y)
+    enemies.awake |= ~enemies.dead & pvs.contains(int(x // TILE_SIZE), int(y // TILE_SIZE),
+                                                   enemies.tile_x, enemies.tile_y)
+    flow_field.update(int(x // TILE_SIZE), int(y // TILE_SIZE))
+    active = chunks.active_enemies(enemies)
+    return enemies.update(x, y, active[enemies.awake[active]], flow_field)
 
 # Convert angle to radians
 def to_radians(degrees):
@@ -231,159 +1267,284 @@ def to_radians(degrees):
 def is_wall(x, y):
     map_x = int(x // TILE_SIZE)
     map_y = int(y // TILE_SIZE)
-    if 0 <= map_x < len(MAP[0]) and 0 <= map_y < len(MAP):
-        return MAP[map_y][map_x] in [1, 2]  # Wall or closed door
+    rows, cols = MAP.shape
+    if 0 <= map_x < cols and 0 <= map_y < rows:
+        return bool(SOLID_CELLS[MAP[map_y, map_x]])  # Wall or closed door
     return True  # Assume out of bounds is a wall
 
+# Check many points at once; returns a boolean array
+def is_wall_array(xs, ys):
+    map_x = np.floor_divide(xs, TILE_SIZE).astype(np.int64)
+    map_y = np.floor_divide(ys, TILE_SIZE).astype(np.int64)
+    rows, cols = MAP.shape
+    inside = (map_x >= 0) & (map_x < cols) & (map_y >= 0) & (map_y < rows)
+    walls = np.ones(len(map_x), dtype=bool)  # Assume out of bounds is a wall
+    walls[inside] = SOLID_CELLS[MAP[map_y[inside], map_x[inside]]]
+    return walls
+
 # Check what's at a specific map position
 def get_map_item(x, y):
     map_x = int(x // TILE_SIZE)
     map_y = int(y // TILE_SIZE)
-    if 0 <= map_x < len(MAP[0]) and 0 <= map_y < len(MAP):
-        return MAP[map_y][map_x]
+    rows, cols = MAP.shape
+    if 0 <= map_x < cols and 0 <= map_y < rows:
+        return int(MAP[map_y, map_x])
     return 1  # Wall by default if out of bounds
 
 # Set map item at a position
 def set_map_item(x, y, item):
     map_x = int(x // TILE_SIZE)
     map_y = int(y // TILE_SIZE)
-    if 0 <= map_x < len(MAP[0]) and 0 <= map_y < len(MAP):
-        MAP[map_y][map_x] = item
+    rows, cols = MAP.shape
+    if 0 <= map_x < cols and 0 <= map_y < rows:
+        set_map_cell(map_x, map_y, item)
+
+# Set map item by tile coordinates, keeping the minimap and pickups in sync
+map_version = 0  # Bumped on every map change
+pristine_cells = {}  # (map_x, map_y) -> item the level had there, for every cell changed since it loaded
+
+def set_map_cell(map_x, map_y, item):
+    global map_version
+    pristine_cells.setdefault((map_x, map_y), int(MAP[map_y, map_x]))
+    MAP[map_y, map_x] = item
+    map_version += 1
+    pvs.map_changed(map_x, map_y)
+    flow_field.map_changed(map_x, map_y)
+    mark_minimap_dirty(map_x, map_y)
+    update_pickup_index(map_x, map_y, item)
+
+# Put every changed cell back the way the level had it. Goes through
+# set_map_cell, so the PVS, flow field, minimap and pickups follow.
+def restore_map():
+    for (map_x, map_y), item in list(pristine_cells.items()):
+        if MAP[map_y, map_x] != item:
+            set_map_cell(map_x, map_y, item)
+    pristine_cells.clear()
+
+# Pickup registry: health (3) and ammo (4) cells grouped into square buckets
+# of PICKUP_BUCKET_SIZE tiles, so queries only visit buckets near the player.
+# A bucket is filled from MAP the first time a query reaches it, so loading a
+# level never scans the whole map.
+PICKUP_ITEMS = (3, 4)
+PICKUP_BUCKET_SIZE = 8
+pickup_buckets = {}  # (bucket_x, bucket_y) -> {(map_x, map_y): item}, for the buckets read so far
+
+def build_pickup_index():
+    pickup_buckets.clear()
+
+# The pickups of a bucket, read from MAP the first time
+def pickup_bucket(bucket_x, bucket_y):
+    bucket = pickup_buckets.get((bucket_x, bucket_y))
+    if bucket is None:
+        first_x, first_y = bucket_x * PICKUP_BUCKET_SIZE, bucket_y * PICKUP_BUCKET_SIZE
+        tiles = MAP[first_y:first_y + PICKUP_BUCKET_SIZE, first_x:first_x + PICKUP_BUCKET_SIZE]
+        ys, xs = np.nonzero(np.isin(tiles, PICKUP_ITEMS))
+        bucket = pickup_buckets[(bucket_x, bucket_y)] = {
+            (first_x + x, first_y + y): int(tiles[y, x]) for x, y in zip(xs.tolist(), ys.tolist())
+        }
+    return bucket
+
+def update_pickup_index(map_x, map_y, item):
+    bucket = pickup_buckets.get((map_x // PICKUP_BUCKET_SIZE, map_y // PICKUP_BUCKET_SIZE))
+    if bucket is None:
+        return  # Not read yet; it will be read from MAP as it is then
+    if item in PICKUP_ITEMS:
+        bucket[(map_x, map_y)] = item
+    else:
+        bucket.pop((map_x, map_y), None)
+
+# Find pickups within radius of a point, optionally only those within
+# half_fov degrees of angle. Returns (distance, rel_angle, map_x, map_y, item)
+def find_pickups(x, y, radius, angle=None, half_fov=None):
+    bucket_span = PICKUP_BUCKET_SIZE * TILE_SIZE
+    last_bucket_x = (MAP.shape[1] - 1) // PICKUP_BUCKET_SIZE
+    last_bucket_y = (MAP.shape[0] - 1) // PICKUP_BUCKET_SIZE
+    first_x, last_x = max(int((x - radius) // bucket_span), 0), min(int((x + radius) // bucket_span), last_bucket_x)
+    first_y, last_y = max(int((y - radius) // bucket_span), 0), min(int((y + radius) // bucket_span), last_bucket_y)
+
+    found = []
+    for bucket_y in range(first_y, last_y + 1):
+        for bucket_x in range(first_x, last_x + 1):
+            bucket = pickup_bucket(bucket_x, bucket_y)
+            for (map_x, map_y), item in bucket.items():
+                dx = (map_x + 0.5) * TILE_SIZE - x
+                dy = (map_y + 0.5) * TILE_SIZE - y
+                distance = math.sqrt(dx*dx + dy*dy)
+                if distance > radius:
+                    continue
+
+                rel_angle = 0
+                if angle is not None:
+                    rel_angle = (math.degrees(math.atan2(dy, dx)) - angle) % 360
+                    if rel_angle > 180:
+                        rel_angle -= 360
+                    if abs(rel_angle) > half_fov:
+                        continue
+                found.append((distance, rel_angle, map_x, map_y, item))
+    return found
+
+build_pickup_index()
+
+# Unit vector for a heading in degrees
+def heading_vector(angle):
+    radians = to_radians(angle)
+    return math.cos(radians), math.sin(radians)
+
+# Per-column view tables, built once per FOV and ray count: the angle of each
+# ray relative to the view direction and its cosine and sine. The cosine is
+# also the fisheye correction for the column.
+ColumnTables = namedtuple("ColumnTables", ["rel_angles", "cos_rel", "sin_rel"])
+
+@functools.lru_cache(maxsize=8)
+def column_tables(rays):
+    rel_angles = -HALF_FOV + FOV * np.arange(rays) / rays
+    tables = ColumnTables(rel_angles, np.cos(np.radians(rel_angles)), np.sin(np.radians(rel_angles)))
+    for table in tables:
+        table.setflags(write=False)  # Shared by every frame
+    return tables
+
+# World-space ray directions for a view angle: the column directions rotated
+# by the view, so a frame needs one heading lookup instead of trig per ray
+def ray_directions(tables, view_angle):
+    cos_v, sin_v = heading_vector(view_angle)
+    dir_x = cos_v * tables.cos_rel - sin_v * tables.sin_rel
+    dir_y = sin_v * tables.cos_rel + cos_v * tables.sin_rel
+    return dir_x, dir_y
+
+# Batched raycasting function (DDA over the active chunks of MAP, all rays at
+# once) for rays given as unit direction vectors. tile_bounds overrides the
+# tiles rays may cross, as (first_x, first_y, end_x, end_y) like
+# ChunkManager.bounds, for cameras away from the player.
+# Returns arrays of distance, vertical-hit flag, texture offset and hit cell
+def cast_rays(dir_x, dir_y, origin_x, origin_y, tile_bounds=None):
+    cos_a = np.asarray(dir_x, dtype=np.float64)
+    sin_a = np.asarray(dir_y, dtype=np.float64)
+    count = cos_a.size
+    first_x, first_y, end_x, end_y = tile_bounds or chunks.bounds
+
+    # Results default to "no wall hit", same as the old scalar caster
+    distances = np.full(count, float(MAX_DEPTH))
+    vertical = np.ones(count, dtype=bool)
+    offsets = np.zeros(count, dtype=np.int64)
+    hit_x = np.zeros(count, dtype=np.int64)
+    hit_y = np.zeros(count, dtype=np.int64)
+
+    # Work in tile units from here on
+    pos_x = origin_x / TILE_SIZE
+    pos_y = origin_y / TILE_SIZE
+    start_x = math.floor(pos_x)
+    start_y = math.floor(pos_y)
+
+    step_x = np.where(cos_a > 0, 1, -1)
+    step_y = np.where(sin_a > 0, 1, -1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Distance along the ray between two vertical / horizontal grid lines
+        delta_x = np.abs(1 / cos_a)
+        delta_y = np.abs(1 / sin_a)
+
+        # Distance along the ray to the first vertical / horizontal grid
+        # line; axis-aligned rays from a grid line give 0 * inf, replaced below
+        side_x = np.where(cos_a > 0, start_x + 1 - pos_x, pos_x - start_x) * delta_x
+        side_y = np.where(sin_a > 0, start_y + 1 - pos_y, pos_y - start_y) * delta_y
+    side_x[np.isinf(delta_x)] = np.inf
+    side_y[np.isinf(delta_y)] = np.inf
+
+    # State of the rays that are still travelling
+    ray_ids = np.arange(count)
+    cell_x = np.full(count, start_x, dtype=np.int64)
+    cell_y = np.full(count, start_y, dtype=np.int64)
+
+    # A ray can cross at most this many grid lines before leaving the
+    # active chunks
+    for _ in range((end_x - first_x) + (end_y - first_y)):
+        if ray_ids.size == 0:
+            break
+
+        # Step every ray to its next grid line
+        along_x = side_x < side_y
+        dist = np.where(along_x, side_x, side_y)
+        side_x = np.where(along_x, side_x + delta_x, side_x)
+        side_y = np.where(along_x, side_y, side_y + delta_y)
+        cell_x = cell_x + np.where(along_x, step_x, 0)
+        cell_y = cell_y + np.where(along_x, 0, step_y)
 
-# Raycasting function
+        # Rays leaving the active chunks keep the default result
+        inside = (cell_x >= first_x) & (cell_x < end_x) & (cell_y >= first_y) & (cell_y < end_y)
+        solid = np.zeros(ray_ids.size, dtype=bool)
+        solid[inside] = SOLID_CELLS[MAP[cell_y[inside], cell_x[inside]]]
+
+        if solid.any():
+            hits = ray_ids[solid]
+            hit_dist = dist[solid] * TILE_SIZE
+            hit_vertical = along_x[solid]
+            wall_x = origin_x + cos_a[solid] * hit_dist
+            wall_y = origin_y + sin_a[solid] * hit_dist
+            distances[hits] = hit_dist
+            vertical[hits] = hit_vertical
+            offsets[hits] = np.where(hit_vertical, wall_y % TILE_SIZE, wall_x % TILE_SIZE).astype(np.int64)
+            hit_x[hits] = cell_x[solid]
+            hit_y[hits] = cell_y[solid]
+
+        # Keep only the rays that are still inside the map and travelling
+        keep = inside & ~solid
+        ray_ids = ray_ids[keep]
+        cos_a, sin_a = cos_a[keep], sin_a[keep]
+        delta_x, delta_y = delta_x[keep], delta_y[keep]
+        step_x, step_y = step_x[keep], step_y[keep]
+        side_x, side_y = side_x[keep], side_y[keep]
+        cell_x, cell_y = cell_x[keep], cell_y[keep]
+
+    return distances, vertical, offsets, hit_x, hit_y
+
+# Raycasting function for a single ray from the player
 def cast_ray(angle):
-    # Ensure angle is between 0 and 360
-    angle %= 360
-    
-    # Convert angle to radians
-    angle_rad = to_radians(angle)
-    
-    # Get direction vectors
-    cos_a = math.cos(angle_rad)
-    sin_a = math.sin(angle_rad)
-    
-    # Initialize variables for the smallest distance
-    min_distance = float('inf')
-    hit_type = None
-    texture_offset = 0
-    map_coords = (0, 0)
-    
-    # Handle horizontal intersections (east-west walls)
-    if abs(sin_a) > 0.0001:
-        # Determine the first horizontal grid intersection
-        if sin_a > 0:  # Looking down
-            y_hor = math.floor(player_y / TILE_SIZE) * TILE_SIZE + TILE_SIZE
-            dy = TILE_SIZE
-        else:  # Looking up
-            y_hor = math.floor(player_y / TILE_SIZE) * TILE_SIZE
-            dy = -TILE_SIZE
-        
-        # Calculate the x-component step size
-        dx = dy / math.tan(angle_rad)
-        
-        # Calculate the first intersection point
-        x_hor = player_x + (y_hor - player_y) / sin_a * cos_a
-        
-        # Step through the grid and check for wall hits
-        for _ in range(100):  # Limit iterations to prevent infinite loop
-            map_x, map_y = int(x_hor // TILE_SIZE), int(y_hor // TILE_SIZE)
-            
-            # Check if we're out of bounds or hit a wall
-            if not (0 <= map_x < len(MAP[0]) and 0 <= map_y < len(MAP)):
-                break
-            
-            map_item = MAP[map_y][map_x]
-            if map_item in [1, 2]:  # Wall or door
-                # Calculate distance to intersection
-                dist = math.sqrt((x_hor - player_x) ** 2 + (y_hor - player_y) ** 2)
-                if dist < min_distance:
-                    min_distance = dist
-                    hit_type = 'h'
-                    texture_offset = int(x_hor % TILE_SIZE)
-                    map_coords = (map_x, map_y)
-                break
-            
-            # Move to next intersection
-            x_hor += dx
-            y_hor += dy
-    
-    # Handle vertical intersections (north-south walls)
-    if abs(cos_a) > 0.0001:
-        # Determine the first vertical grid intersection
-        if cos_a > 0:  # Looking right
-            x_vert = math.floor(player_x / TILE_SIZE) * TILE_SIZE + TILE_SIZE
-            dx = TILE_SIZE
-        else:  # Looking left
-            x_vert = math.floor(player_x / TILE_SIZE) * TILE_SIZE
-            dx = -TILE_SIZE
-        
-        # Calculate the y-component step size
-        dy = dx * math.tan(angle_rad)
-        
-        # Calculate the first intersection point
-        y_vert = player_y + (x_vert - player_x) * math.tan(angle_rad)
-        
-        # Step through the grid and check for wall hits
-        for _ in range(100):  # Limit iterations to prevent infinite loop
-            map_x, map_y = int(x_vert // TILE_SIZE), int(y_vert // TILE_SIZE)
-            
-            # Check if we're out of bounds or hit a wall
-            if not (0 <= map_x < len(MAP[0]) and 0 <= map_y < len(MAP)):
-                break
-            
-            map_item = MAP[map_y][map_x]
-            if map_item in [1, 2]:  # Wall or door
-                # Calculate distance to intersection
-                dist = math.sqrt((x_vert - player_x) ** 2 + (y_vert - player_y) ** 2)
-                if dist < min_distance:
-                    min_distance = dist
-                    hit_type = 'v'
-                    texture_offset = int(y_vert % TILE_SIZE)
-                    map_coords = (map_x, map_y)
-                break
-            
-            # Move to next intersection
-            x_vert += dx
-            y_vert += dy
-    
-    # Return the closest intersection
-    if min_distance == float('inf'):
-        # No wall was hit, return a default value
-        return MAX_DEPTH, 'v', 0, (0, 0)
-    
-    return min_distance, hit_type, texture_offset, map_coords
+    dir_x, dir_y = heading_vector(angle % 360)
+    distances, vertical, offsets, hit_x, hit_y = cast_rays((dir_x,), (dir_y,), player_x, player_y)
+    hit_type = 'v' if vertical[0] else 'h'
+    return float(distances[0]), hit_type, int(offsets[0]), (int(hit_x[0]), int(hit_y[0]))
+
+# Sprite kinds: texture asset and size relative to a wall
+SPRITE_TEXTURES = ("enemy_texture", "health_texture", "ammo_texture")
+SPRITE_SCALES = np.array([1.0, 0.5, 0.5])
+ENEMY_SPRITE, HEALTH_SPRITE, AMMO_SPRITE = range(3)
+PICKUP_SPRITES = {3: HEALTH_SPRITE, 4: AMMO_SPRITE}
+
+# Project sprites at world positions to a width x height screen in one
+# pass. Returns the distance, size and left screen column of the sprites
+# that overlap the screen, farthest first, with their indices into the inputs.
+def project_sprites(view_x, view_y, view_angle, sprite_x, sprite_y, kinds, width=WIDTH, height=HEIGHT):
+    dx = sprite_x - view_x
+    dy = sprite_y - view_y
+    distance = np.sqrt(dx*dx + dy*dy)
+    rel_angle = (np.degrees(np.arctan2(dy, dx)) - view_angle + 180) % 360 - 180
+
+    scales = SPRITE_SCALES[kinds]
+    with np.errstate(divide='ignore'):
+        sizes = np.minimum(height / distance * TILE_SIZE * scales, height * 2 * scales).astype(int)
+    left = (rel_angle / FOV * width + width / 2 - sizes / 2).astype(int)
 
-# Find visible enemies
-def find_visible_enemies(fov_start, fov_end):
-    visible = []
-    
-    for i, enemy in enumerate(enemies):
-        if enemy.dead:
-            continue
-            
-        # Calculate angle and distance to enemy
-        dx = enemy.x - player_x
-        dy = enemy.y - player_y
-        angle = math.degrees(math.atan2(dy, dx)) % 360
-        distance = math.sqrt(dx*dx + dy*dy)
-        
-        # Check if enemy is in player's FOV
-        rel_angle = (angle - player_angle) % 360
-        if rel_angle > 180:
-            rel_angle -= 360
-            
-        if abs(rel_angle) <= HALF_FOV:
-            # Check if enemy is not behind a wall
-            ray_dist, _, _, _ = cast_ray(angle)
-            if distance < ray_dist:
-                sprite_size = min(int(HEIGHT / distance * TILE_SIZE), HEIGHT * 2)
-                # Calculate position on screen
-                sprite_x = int(rel_angle / FOV * WIDTH + WIDTH / 2 - sprite_size / 2)
-                visible.append((distance, sprite_size, sprite_x, i))
-    
     # Sort by distance (farther sprites drawn first)
-    visible.sort(reverse=True)
-    return visible
+    shown = np.nonzero((distance > 0) & (sizes > 0) & (left < width) & (left + sizes > 0))[0]
+    shown = shown[np.argsort(-distance[shown], kind="stable")]
+    return distance[shown], sizes[shown], left[shown], shown
+
+# Blit projected sprites, clipped column by column against the wall depth
+# of each screen column: only the runs of columns where the sprite is nearer
+# than the wall are drawn
+def draw_sprites(surface, column_depth, distance, sizes, left, kinds):
+    width = len(column_depth)
+    for sprite_distance, size, x, kind in zip(distance.tolist(), sizes.tolist(), left.tolist(), kinds.tolist()):
+        first_column = max(x, 0)
+        shown = sprite_distance < column_depth[first_column:min(x + size, width)]
+        if not shown.any():
+            continue
+
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], shown.view(np.int8), [0])))).tolist()
+        sprite = pygame.transform.scale(assets[SPRITE_TEXTURES[kind]], (size, size))
+        top = surface.get_height() // 2 - size // 2
+        for start, end in zip(edges[::2], edges[1::2]):
+            column = first_column + start
+            surface.blit(sprite, (column, top), (column - x, 0, end - start, size))
 
 # Handle player firing weapon
 def player_fire():
@@ -404,23 +1565,19 @@ def player_fire():
     # Play sound
     if current_weapon == "pistol":
         pistol_ammo -= 1
-        try:
-            pistol_sound.play()
-        except:
-            pass
+        play_sound("pistol_sound")
     elif current_weapon == "shotgun":
         shotgun_ammo -= 1
-        try:
-            shotgun_sound.play()
-        except:
-            pass
+        play_sound("shotgun_sound")
     elif current_weapon == "bfg":
         bfg_ammo -= 1
-        try:
-            bfg_sound.play()
-        except:
-            pass
-    
+        play_sound("bfg_sound")
+
+    return fire_shot()
+
+# Resolve a shot of the current weapon against the enemies; returns whether
+# it killed one
+def fire_shot():
     # Calculate damage
     if current_weapon == "pistol":
         damage = 20
@@ -437,261 +1594,476 @@ def player_fire():
     if current_weapon == "shotgun":
         # Shotgun fires multiple pellets
         for _ in range(8):
-            spray_angle = player_angle + random.uniform(-spread, spread)
+            spray_angle = player_angle + rng.uniform(-spread, spread)
             hit_enemy = hit_enemy or fire_projectile(spray_angle, damage // 2)
     elif current_weapon == "bfg":
         # BFG hits all enemies in cone
-        for enemy in enemies:
-            if enemy.dead:
-                continue
-                
-            dx = enemy.x - player_x
-            dy = enemy.y - player_y
-            angle = math.degrees(math.atan2(dy, dx))
-            rel_angle = (angle - player_angle) % 360
-            if rel_angle > 180:
-                rel_angle -= 360
-                
-            if abs(rel_angle) <= spread:
-                distance = math.sqrt(dx*dx + dy*dy)
-                if distance < TILE_SIZE * 10:  # BFG range
-                    killed = enemy.take_damage(damage)
-                    if killed:
-                        hit_enemy = True
+        bfg_range = TILE_SIZE * 10
+        indices, distance, rel_angle = enemies.query_cone(player_x, player_y, player_angle, spread, bfg_range)
+        for index in indices[(np.abs(rel_angle) <= spread) & (distance < bfg_range)].tolist():
+            killed = enemies.take_damage(index, damage)
+            if killed:
+                hit_enemy = True
     else:
         # Pistol fires single shot
-        spray_angle = player_angle + random.uniform(-spread, spread)
+        spray_angle = player_angle + rng.uniform(-spread, spread)
         hit_enemy = fire_projectile(spray_angle, damage)
     
     return hit_enemy
 
-# Fire a single projectile
-def fire_projectile(angle, damage):
-    ray_dist, _, _, coords = cast_ray(angle)
-    
-    for i, enemy in enumerate(enemies):
-        if enemy.dead:
-            continue
-            
-        # Calculate distance to enemy
-        dx = enemy.x - player_x
-        dy = enemy.y - player_y
-        distance = math.sqrt(dx*dx + dy*dy)
-        
-        # Check if enemy is hit
-        enemy_angle = math.degrees(math.atan2(dy, dx))
-        rel_angle = (enemy_angle - angle) % 360
-        if rel_angle > 180:
-            rel_angle -= 360
-            
-        if abs(rel_angle) < 5 and distance < ray_dist:
-            # Hit! Calculate damage falloff with distance
-            damage_dealt = max(damage * (1 - distance / (TILE_SIZE * 10)), damage / 2)
-            killed = enemy.take_damage(int(damage_dealt))
-            return killed
-    
-    return False
+# Fire a single projectile
+def fire_projectile(angle, damage):
+    ray_dist, _, _, coords = cast_ray(angle)
+
+    # A projectile hits enemies within 5 degrees of its path, up to the wall,
+    # so only enemies in the tiles of that narrow cone need checking
+    indices, distance, rel_angle = enemies.query_cone(player_x, player_y, angle, 5, ray_dist)
+    hits = np.nonzero((np.abs(rel_angle) < 5) & (distance < ray_dist))[0]
+    if hits.size == 0:
+        return False
+
+    # Hit! Calculate damage falloff with distance
+    hit = hits[0]
+    damage_dealt = max(damage * (1 - distance[hit] / (TILE_SIZE * 10)), damage / 2)
+    killed = enemies.take_damage(int(indices[hit]), int(damage_dealt))
+    return killed
+
+# wall_palette converted to pixel values, per surface pixel format
+mapped_palettes = {}
+
+def get_mapped_palette(surface, dtype):
+    key = (surface.get_bitsize(), surface.get_masks())
+    if key not in mapped_palettes:
+        mapped = pygame.surfarray.map_array(surface, assets["wall_palette"])
+        mapped_palettes[key] = mapped.astype(dtype)
+    return mapped_palettes[key]
+
+# LRU cache of scaled wall strips, keyed on texture id, column offset, hit
+# side and wall height. A strip holds the palette values of the screen rows
+# the wall column covers, so a repeated column is a single slice copy.
+class ColumnCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.strips = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.palette = None
+        self.screen_height = 0
+
+    # Strips depend on the palette and the screen height, drop them on change
+    def bind(self, palette, screen_height):
+        if palette is not self.palette or screen_height != self.screen_height:
+            self.clear()
+            self.palette = palette
+            self.screen_height = screen_height
+
+    def clear(self):
+        self.strips.clear()
+        self.size = 0
+
+    def get_strip(self, texture_id, offset, vertical, wall_height):
+        key = (texture_id, offset, vertical, wall_height)
+        strip = self.strips.get(key)
+        if strip is not None:
+            self.strips.move_to_end(key)
+            self.hits += 1
+            return strip
+
+        self.misses += 1
+        top = self.screen_height // 2 - wall_height // 2
+        first_row = max(0, top)
+        last_row = min(self.screen_height, top + wall_height)
+        texel_rows = (np.arange(first_row, last_row) - top) * TILE_SIZE // wall_height
+        column = ((texture_id * 2 + vertical) * TILE_SIZE + offset) * TILE_SIZE
+        strip = self.palette[column + texel_rows]
+
+        self.strips[key] = strip
+        self.size += strip.nbytes
+        while self.size > self.max_bytes and self.strips:
+            _, evicted = self.strips.popitem(last=False)
+            self.size -= evicted.nbytes
+            self.evictions += 1
+        return strip
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "strips": len(self.strips),
+            "bytes": self.size,
+        }
+
+column_cache = ColumnCache(COLUMN_CACHE_BYTES)
+
+# NumPy view of a surface's pixels and the matching wall palette: one mapped
+# value per pixel unless the surface is 24-bit
+def surface_pixels(surface):
+    if surface.get_bytesize() != 3:
+        pixels = pygame.surfarray.pixels2d(surface)
+        return pixels, get_mapped_palette(surface, pixels.dtype)
+    return pygame.surfarray.pixels3d(surface), assets["wall_palette"]
+
+# Wall column heights for a batch of rays, with the fisheye effect removed
+# by the per-column correction (cosine of the ray's angle off the view)
+def wall_column_heights(distances, correction, screen_height):
+    corrected = distances * correction
+    safe = np.where(corrected > 0, corrected, 1)
+    heights = np.minimum(screen_height / safe * TILE_SIZE, screen_height * 2)
+    return np.where(corrected > 0, heights, screen_height).astype(int)
+
+# Fill a surface with sky, floor and textured wall columns, one ray per
+# group of screen columns
+def draw_walls(surface, wall_heights, vertical, offsets, texture_ids):
+    pixels, palette = surface_pixels(surface)
+    if column_cache.max_bytes > 0:
+        draw_cached_columns(pixels, palette, wall_heights, vertical, offsets, texture_ids)
+    else:
+        draw_indexed_columns(pixels, palette, wall_heights, vertical, offsets, texture_ids)
+    del pixels  # Unlock the surface for sprite blits
+
+# Copy cached wall strips into the pixel array column by column
+def draw_cached_columns(pixels, palette, wall_heights, vertical, offsets, texture_ids):
+    width, height = pixels.shape[:2]
+    half_height = height // 2
+    column_cache.bind(palette, height)
+
+    # Sky and floor first, walls on top
+    pixels[:, :half_height] = palette[SKY_INDEX]
+    pixels[:, half_height:] = palette[FLOOR_INDEX]
+
+    # Screen columns covered by each ray
+    ray_count = len(wall_heights)
+    column_rays = np.arange(width) * ray_count // width
+    starts = np.searchsorted(column_rays, np.arange(ray_count + 1)).tolist()
+
+    rays = zip(wall_heights.tolist(), vertical.tolist(), offsets.tolist(), texture_ids.tolist())
+    for i, (wall_height, is_vertical, offset, texture_id) in enumerate(rays):
+        if starts[i] == starts[i + 1]:
+            continue
+        wall_height = max(wall_height, 1)
+        strip = column_cache.get_strip(texture_id, offset, is_vertical, wall_height)
+        first_row = max(0, half_height - wall_height // 2)
+        pixels[starts[i]:starts[i + 1], first_row:first_row + len(strip)] = strip
+
+# Build a palette index for every pixel and write the frame in one take()
+def draw_indexed_columns(pixels, palette, wall_heights, vertical, offsets, texture_ids, column_rays=None):
+    width, height = pixels.shape[:2]
+    half_height = height // 2
+
+    # Ray feeding each screen column
+    if column_rays is None:
+        column_rays = np.arange(width) * len(wall_heights) // width
+    heights = np.maximum(wall_heights[column_rays], 1).astype(np.int32)[:, None]
+    tops = half_height - heights // 2
+
+    # Texel index of the column (texture, shade, column offset) ...
+    columns = (texture_ids[column_rays] * 2 + vertical[column_rays]) * TILE_SIZE + offsets[column_rays]
+    columns = (columns * TILE_SIZE)[:, None].astype(np.int32)
+
+    # ... plus the texture row for every screen row covered by the wall
+    rows = np.arange(height, dtype=np.int32)[None, :] - tops
+    inside = (rows >= 0) & (rows < heights)
+    texel_rows = rows * TILE_SIZE // heights  # Same integer scaling as ColumnCache.get_strip
+
+    background = np.where(np.arange(height) < half_height, SKY_INDEX, FLOOR_INDEX).astype(np.int32)
+    indices = np.where(inside, columns + texel_rows, background[None, :])
+    palette.take(indices, axis=0, out=pixels)
+
+# Worker pool for the threaded wall pass, created on first use
+render_pool = None
+
+# Multi-threaded wall pass: the rays are split into RENDER_THREADS bands and
+# each band is raycast and filled with the per-pixel kernel on a worker. The
+# bands write disjoint columns of the same framebuffer view, and the bulk
+# NumPy work releases the GIL, so they run in parallel. Returns the z-buffer.
+def draw_walls_threaded(surface, dir_x, dir_y, correction, view_x, view_y, tile_bounds=None):
+    global render_pool
+    if render_pool is None:
+        render_pool = ThreadPoolExecutor(max_workers=RENDER_THREADS, thread_name_prefix="render")
+
+    z_buffer = np.empty(len(dir_x))
+    pixels, palette = surface_pixels(surface)
+    bounds = np.linspace(0, len(dir_x), RENDER_THREADS + 1).astype(int).tolist()
+    futures = [
+        render_pool.submit(draw_wall_band, pixels, palette, dir_x, dir_y, correction, first_ray, last_ray,
+                           view_x, view_y, z_buffer, tile_bounds)
+        for first_ray, last_ray in zip(bounds, bounds[1:])
+    ]
+    for future in futures:
+        future.result()
+    del pixels  # Unlock the surface for sprite blits
+    return z_buffer
+
+# Raycast rays [first_ray, last_ray) and fill the screen columns they feed
+def draw_wall_band(pixels, palette, dir_x, dir_y, correction, first_ray, last_ray, view_x, view_y, z_buffer,
+                   tile_bounds=None):
+    ray_count = len(dir_x)
+    width, height = pixels.shape[:2]
+    first_column = -(-first_ray * width // ray_count)
+    last_column = -(-last_ray * width // ray_count)
+
+    band = slice(first_ray, last_ray)
+    distances, vertical, offsets, hit_x, hit_y = cast_rays(dir_x[band], dir_y[band], view_x, view_y, tile_bounds)
+    z_buffer[band] = distances
+    if first_column == last_column:
+        return
+
+    wall_heights = wall_column_heights(distances, correction[band], height)
+    texture_ids = WALL_TEXTURE_IDS[MAP[hit_y, hit_x]]
+    column_rays = np.arange(first_column, last_column) * ray_count // width - first_ray
+    draw_indexed_columns(pixels[first_column:last_column], palette, wall_heights, vertical, offsets,
+                         texture_ids, column_rays)
+
+# Draw the 3D scene from a camera pose; alpha blends enemy positions
+# between the last two simulation ticks. Rays stay in the active chunks
+# unless tile_bounds (see cast_rays) says otherwise.
+def draw_scene(view_x, view_y, view_angle, alpha=1.0, surface=None, rays=None, tile_bounds=None):
+    if surface is None:
+        surface = screen
+    width, height = surface.get_size()
+
+    # Rotate the precomputed column directions to the view
+    tables = column_tables(rays or min(ray_count, width))
+    dir_x, dir_y = ray_directions(tables, view_angle)
+
+    if RENDER_THREADS > 1:
+        # Raycast and draw walls in parallel bands
+        z_buffer = draw_walls_threaded(surface, dir_x, dir_y, tables.cos_rel, view_x, view_y, tile_bounds)
+    else:
+        # Cast all rays in one batch
+        distances, vertical, offsets, hit_x, hit_y = cast_rays(dir_x, dir_y, view_x, view_y, tile_bounds)
+
+        # Store distances in z-buffer for sprite rendering
+        z_buffer = distances
 
-# Draw the 3D scene
-def draw_scene():
-    # Fill background with a sky and floor
-    pygame.draw.rect(screen, (50, 50, 100), (0, 0, WIDTH, HALF_HEIGHT))
-    pygame.draw.rect(screen, (50, 50, 50), (0, HALF_HEIGHT, WIDTH, HALF_HEIGHT))
+        # Draw walls straight into the screen pixels
+        wall_heights = wall_column_heights(distances, tables.cos_rel, height)
+        texture_ids = WALL_TEXTURE_IDS[MAP[hit_y, hit_x]]
+        draw_walls(surface, wall_heights, vertical, offsets, texture_ids)
 
-    # Prepare z-buffer for sprite rendering
-    z_buffer = [float('inf')] * WIDTH
+    # Collect enemies and pickups in tiles potentially visible from the
+    # camera's tile; nothing beyond the farthest wall hit this frame can be
+    # visible
+    view_tile_x, view_tile_y = int(view_x // TILE_SIZE), int(view_y // TILE_SIZE)
+    enemy_x, enemy_y = enemies.interpolate(alpha)
+    shown_enemies = np.flatnonzero(~enemies.dead & pvs.contains(view_tile_x, view_tile_y,
+                                                                enemies.tile_x, enemies.tile_y))
+    pickups = [(map_x, map_y, item) for _, _, map_x, map_y, item in find_pickups(view_x, view_y, float(z_buffer.max()))]
+    pickup_x, pickup_y, pickup_items = np.array(pickups, dtype=np.int64).reshape(-1, 3).T
+    visible = pvs.contains(view_tile_x, view_tile_y, pickup_x, pickup_y)
+    pickup_x, pickup_y, pickup_items = pickup_x[visible], pickup_y[visible], pickup_items[visible]
+    sprite_x = np.concatenate([enemy_x[shown_enemies], (pickup_x + 0.5) * TILE_SIZE])
+    sprite_y = np.concatenate([enemy_y[shown_enemies], (pickup_y + 0.5) * TILE_SIZE])
+    kinds = np.concatenate([np.full(len(shown_enemies), ENEMY_SPRITE),
+                            [PICKUP_SPRITES[item] for item in pickup_items.tolist()]]).astype(np.int64)
 
-    # Cast rays and draw walls
-    for i in range(RAY_COUNT):
-        # Calculate ray angle
-        ray_angle = player_angle - HALF_FOV + FOV * i / RAY_COUNT
-        
-        # Cast ray
-        distance, hit_type, texture_offset, map_coords = cast_ray(ray_angle)
-        
-        # Store distance in z-buffer
-        z_buffer[i] = distance
-        
-        # Fix fisheye effect
-        correct_angle = to_radians(ray_angle - player_angle)
-        distance = distance * math.cos(correct_angle)
-        
-        # Calculate wall height
-        wall_height = min(int(HEIGHT / distance * TILE_SIZE), HEIGHT * 2) if distance > 0 else HEIGHT
-        
-        # Determine wall texture based on map item
-        if map_coords[0] >= 0 and map_coords[1] >= 0:
-            map_item = MAP[map_coords[1]][map_coords[0]]
-            if map_item == 1:  # Wall
-                texture = wall_texture
-            elif map_item == 2:  # Door
-                texture = door_texture
-            else:
-                texture = wall_texture
-        else:
-            texture = wall_texture
-        
-        # Get texture column
-        if 0 <= texture_offset < TILE_SIZE:
-            wall_column = texture.subsurface((texture_offset, 0, 1, TILE_SIZE))
-            wall_column = pygame.transform.scale(wall_column, (int(SCALE), wall_height))
-            
-            if hit_type == 'v':
-                # Apply shadow for vertical hits
-                shadow = pygame.Surface(wall_column.get_size(), pygame.SRCALPHA)
-                shadow.fill((0, 0, 0, 50))
-                wall_column.blit(shadow, (0, 0))
-        else:
-            # Fallback color if texture_offset is out of range
-            wall_column = pygame.Surface((int(SCALE), wall_height))
-            wall_column.fill(BROWN if hit_type == 'h' else DARK_GRAY)
-        
-        # Draw the wall strip
-        wall_pos = (int(i * SCALE), HALF_HEIGHT - wall_height // 2)
-        screen.blit(wall_column, wall_pos)
-    
-    # Draw visible enemies
-    visible_enemies = find_visible_enemies(player_angle - HALF_FOV, player_angle + HALF_FOV)
-    for distance, size, x_pos, enemy_idx in visible_enemies:
-        # Calculate sprite height based on distance
-        enemy = enemies[enemy_idx]
-        sprite = pygame.transform.scale(enemy_texture, (size, size))
-        
-        # Draw the sprite
-        y_pos = HALF_HEIGHT - size // 2
-        screen.blit(sprite, (x_pos, y_pos))
-    
-    # Draw items (health packs, ammo)
-    for y, row in enumerate(MAP):
-        for x, cell in enumerate(row):
-            if cell in [3, 4]:  # Health pack or ammo
-                # Calculate distance and angle to item
-                item_x = (x + 0.5) * TILE_SIZE
-                item_y = (y + 0.5) * TILE_SIZE
-                dx = item_x - player_x
-                dy = item_y - player_y
-                item_dist = math.sqrt(dx*dx + dy*dy)
-                item_angle = math.degrees(math.atan2(dy, dx)) % 360
-                
-                # Check if item is in player's FOV
-                rel_angle = (item_angle - player_angle) % 360
-                if rel_angle > 180:
-                    rel_angle -= 360
-                    
-                if abs(rel_angle) <= HALF_FOV:
-                    # Check if item is not behind a wall
-                    ray_dist = z_buffer[int((rel_angle + HALF_FOV) / FOV * RAY_COUNT)]
-                    if item_dist < ray_dist:
-                        # Calculate item size based on distance
-                        item_size = min(int(HEIGHT / item_dist * TILE_SIZE / 2), HEIGHT)
-                        texture = health_texture if cell == 3 else ammo_texture
-                        item_sprite = pygame.transform.scale(texture, (item_size, item_size))
-                        
-                        # Calculate position on screen
-                        item_x_screen = int(WIDTH / 2 + rel_angle / FOV * WIDTH - item_size / 2)
-                        item_y_screen = HALF_HEIGHT - item_size // 2
-                        
-                        # Draw the item
-                        screen.blit(item_sprite, (item_x_screen, item_y_screen))
+    # Project them together and draw them against the wall depth of every
+    # screen column
+    distance, sizes, left, shown = project_sprites(view_x, view_y, view_angle, sprite_x, sprite_y, kinds, width, height)
+    column_depth = z_buffer[np.arange(width) * len(z_buffer) // width]
+    draw_sprites(surface, column_depth, distance, sizes, left, kinds[shown])
+    return column_depth
 
-# Draw weapon
-def draw_weapon():
+# Advance the firing animation by one simulation tick
+def update_weapon():
     global is_firing, firing_frame
-    
+    if is_firing:
+        firing_frame -= 1
+        if firing_frame <= 0:
+            is_firing = False
+
+# The HUD, weapon and minimap are laid out for the WIDTH x HEIGHT screen;
+# on other surfaces they are scaled by this factor
+def overlay_scale(width, height):
+    return min(width / WIDTH, height / HEIGHT)
+
+# An image asset at an overlay scale, scaled copies cached per scale
+def overlay_image(name, scale):
+    if scale == 1:
+        return assets[name]
+    return scaled_image(name, scale)
+
+@functools.lru_cache(maxsize=16)
+def scaled_image(name, scale):
+    image = assets[name]
+    size = (max(1, round(image.get_width() * scale)), max(1, round(image.get_height() * scale)))
+    return pygame.transform.smoothscale(image, size)
+
+# Draw weapon
+def draw_weapon(surface=None):
+    if surface is None:
+        surface = screen
+    width, height = surface.get_size()
+    scale = overlay_scale(width, height)
     if current_weapon == "pistol":
-        weapon_img = pistol_image
-        weapon_x = WIDTH // 2 - pistol_image.get_width() // 2
-        weapon_y = HEIGHT - pistol_image.get_height() + 20
+        weapon_img = overlay_image("pistol_image", scale)
     elif current_weapon == "shotgun":
-        weapon_img = shotgun_image
-        weapon_x = WIDTH // 2 - shotgun_image.get_width() // 2
-        weapon_y = HEIGHT - shotgun_image.get_height() + 20
+        weapon_img = overlay_image("shotgun_image", scale)
     else:  # BFG
-        weapon_img = bfg_image
-        weapon_x = WIDTH // 2 - bfg_image.get_width() // 2
-        weapon_y = HEIGHT - bfg_image.get_height() + 20
+        weapon_img = overlay_image("bfg_image", scale)
+    weapon_x = width // 2 - weapon_img.get_width() // 2
+    weapon_y = height - weapon_img.get_height() + round(20 * scale)
     
     # Apply firing animation
     if is_firing:
-        weapon_y -= 10
-        firing_frame -= 1
-        if firing_frame <= 0:
-            is_firing = False
-        
+        weapon_y -= round(10 * scale)
+
         # Draw muzzle flash
         if firing_frame > 3:
-            flash_x = WIDTH // 2
-            flash_y = HEIGHT - weapon_img.get_height() // 2
-            screen.blit(muzzle_flash, (flash_x - muzzle_flash.get_width() // 2, flash_y - muzzle_flash.get_height() // 2))
+            flash_x = width // 2
+            flash_y = height - weapon_img.get_height() // 2
+            muzzle_flash = overlay_image("muzzle_flash", scale)
+            surface.blit(muzzle_flash, (flash_x - muzzle_flash.get_width() // 2, flash_y - muzzle_flash.get_height() // 2))
     
     # Draw weapon
-    screen.blit(weapon_img, (weapon_x, weapon_y))
+    surface.blit(weapon_img, (weapon_x, weapon_y))
+
+# Screen strip the HUD text is drawn in
+HUD_AREA = pygame.Rect(0, HEIGHT - 70, WIDTH, 70)
+
+# Rendered HUD text, keyed by text, colour and overlay scale; the values
+# change rarely, so most frames blit cached surfaces instead of rasterizing text
+@functools.lru_cache(maxsize=64)
+def hud_text(text, color, scale=1):
+    rendered = assets["hud_font"].render(text, True, color)
+    if scale != 1:
+        size = (max(1, round(rendered.get_width() * scale)), max(1, round(rendered.get_height() * scale)))
+        rendered = pygame.transform.smoothscale(rendered, size)
+    return rendered
+
+# HUD text lines for the current state, as (text, colour, position) on a
+# width x height screen
+def hud_lines(width=WIDTH, height=HEIGHT):
+    scale = overlay_scale(width, height)
+    left = round(10 * scale)
+    bottom = height - round(40 * scale)
 
-# Draw HUD
-def draw_hud():
-    # Health
-    health_text = hud_font.render(f"Health: {player_health}", True, RED if player_health < 25 else WHITE)
-    screen.blit(health_text, (10, HEIGHT - 70))
-    
     # Ammo
     if current_weapon == "pistol":
-        ammo_text = hud_font.render(f"Pistol: {pistol_ammo}", True, YELLOW if pistol_ammo < 10 else WHITE)
+        ammo = (f"Pistol: {pistol_ammo}", YELLOW if pistol_ammo < 10 else WHITE)
     elif current_weapon == "shotgun":
-        ammo_text = hud_font.render(f"Shotgun: {shotgun_ammo}", True, YELLOW if shotgun_ammo < 5 else WHITE)
+        ammo = (f"Shotgun: {shotgun_ammo}", YELLOW if shotgun_ammo < 5 else WHITE)
     else:
-        ammo_text = hud_font.render(f"BFG: {bfg_ammo}", True, YELLOW if bfg_ammo < 2 else WHITE)
-    screen.blit(ammo_text, (10, HEIGHT - 40))
-    
-    # Weapon selector
-    weapons_text = hud_font.render("1:Pistol 2:Shotgun 3:BFG", True, WHITE)
-    screen.blit(weapons_text, (WIDTH - 250, HEIGHT - 40))
-
-def draw_minimap(player_x, player_y, player_angle):
-    # Set minimap size and position
-    map_size = 120
-    tile_size = map_size / max(len(MAP[0]), len(MAP))
-    map_pos = (WIDTH - map_size - 10, 10)
-    
-    # Create minimap surface
-    minimap = pygame.Surface((map_size, map_size), pygame.SRCALPHA)
-    minimap.fill((0, 0, 0, 128))  # Semi-transparent background
-    
-    # Draw map tiles
-    for y, row in enumerate(MAP):
-        for x, tile in enumerate(row):
-            if tile == 1:  # Wall
-                color = BROWN
-            elif tile == 2:  # Door
-                color = (100, 50, 0)
-            elif tile == 3:  # Health
-                color = RED
-            elif tile == 4:  # Ammo
-                color = YELLOW
-            else:  # Empty space
-                color = DARK_GRAY
-            
-            rect = (x * tile_size, y * tile_size, tile_size, tile_size)
-            pygame.draw.rect(minimap, color, rect)
-    
-    # Draw enemies on minimap
-    for enemy in enemies:
-        if not enemy.dead:
-            ex = enemy.x / TILE_SIZE * tile_size
-            ey = enemy.y / TILE_SIZE * tile_size
-            pygame.draw.circle(minimap, RED, (int(ex), int(ey)), int(tile_size / 3))
-    
+        ammo = (f"BFG: {bfg_ammo}", YELLOW if bfg_ammo < 2 else WHITE)
+
+    return (
+        (f"Health: {player_health}", RED if player_health < 25 else WHITE, (left, height - round(70 * scale))),
+        ammo + ((left, bottom),),
+        ("1:Pistol 2:Shotgun 3:BFG", WHITE, (width - round(250 * scale), bottom)),  # Weapon selector
+    )
+
+# Draw HUD
+def draw_hud(surface=None):
+    if surface is None:
+        surface = screen
+    scale = overlay_scale(*surface.get_size())
+    for text, color, position in hud_lines(*surface.get_size()):
+        surface.blit(hud_text(text, color, scale), position)
+
+# Minimap tile layer, drawn once and then patched tile by tile when
+# set_map_cell() changes the map
+MINIMAP_SIZE = 120
+minimap_layer = None
+minimap_dirty_tiles = set()
+minimap_columns = None  # Map column sampled by each minimap pixel column (-1 for none)
+minimap_rows = None  # Map row sampled by each minimap pixel row (-1 for none)
+
+# Minimap colour of each map item
+MINIMAP_COLORS = np.array([DARK_GRAY] * 256, dtype=np.uint8)  # Empty space
+MINIMAP_COLORS[1] = BROWN  # Wall
+MINIMAP_COLORS[2] = (100, 50, 0)  # Door
+MINIMAP_COLORS[3] = RED  # Health
+MINIMAP_COLORS[4] = YELLOW  # Ammo
+
+def mark_minimap_dirty(map_x, map_y):
+    minimap_dirty_tiles.add((map_x, map_y))
+
+# Tile drawn at each minimap pixel along one axis. Tiles are squares that
+# start at int(tile * tile_size) and are int(tile_size) pixels wide, which
+# leaves a one pixel seam between them; tiles smaller than a pixel (large
+# levels) cover the pixel they start on, and the last one to start there wins.
+def minimap_axis_tiles(tile_count, tile_size):
+    starts = (np.arange(tile_count) * tile_size).astype(np.int64)
+    pixels = np.arange(MINIMAP_SIZE)
+    tiles = np.searchsorted(starts, pixels, side="right") - 1
+    covered = pixels < starts[tiles] + max(int(tile_size), 1)
+    return np.where(covered, tiles, -1)
+
+# Paint the minimap pixels at the given pixel columns and rows from the map
+def draw_minimap_pixels(layer, pixel_x, pixel_y):
+    pixel_x = pixel_x[minimap_columns[pixel_x] >= 0]
+    pixel_y = pixel_y[minimap_rows[pixel_y] >= 0]
+    if pixel_x.size == 0 or pixel_y.size == 0:
+        return
+    tiles = MAP[np.ix_(minimap_rows[pixel_y], minimap_columns[pixel_x])]
+    colors = pygame.surfarray.pixels3d(layer)
+    alpha = pygame.surfarray.pixels_alpha(layer)
+    colors[np.ix_(pixel_x, pixel_y)] = MINIMAP_COLORS[tiles.T]
+    alpha[np.ix_(pixel_x, pixel_y)] = 255
+    del colors, alpha  # Unlock the layer
+
+def draw_minimap(player_x, player_y, player_angle, surface=None):
+    global minimap_layer, minimap_columns, minimap_rows
+    if surface is None:
+        surface = screen
+
+    # Set minimap size and position; the tile layer is kept at the native
+    # size and scaled with the other overlays when it is drawn
+    scale = overlay_scale(*surface.get_size())
+    map_size = max(1, round(MINIMAP_SIZE * scale))
+    tile_size = map_size / max(MAP.shape)
+    margin = round(10 * scale)
+    map_pos = (surface.get_width() - map_size - margin, margin)
+
+    if minimap_layer is None:
+        # Create minimap tile layer, sampling only the tiles it shows
+        layer_tile_size = MINIMAP_SIZE / max(MAP.shape)
+        minimap_columns = minimap_axis_tiles(MAP.shape[1], layer_tile_size)
+        minimap_rows = minimap_axis_tiles(MAP.shape[0], layer_tile_size)
+        minimap_layer = pygame.Surface((MINIMAP_SIZE, MINIMAP_SIZE), pygame.SRCALPHA)
+        minimap_layer.fill((0, 0, 0, 128))  # Semi-transparent background
+        pixels = np.arange(MINIMAP_SIZE)
+        draw_minimap_pixels(minimap_layer, pixels, pixels)
+        minimap_dirty_tiles.clear()
+    elif minimap_dirty_tiles:
+        # Redraw only the pixels of the tiles that changed since the last frame
+        for x, y in minimap_dirty_tiles:
+            draw_minimap_pixels(minimap_layer, np.nonzero(minimap_columns == x)[0],
+                                np.nonzero(minimap_rows == y)[0])
+        minimap_dirty_tiles.clear()
+
+    # Draw tile layer on screen
+    if map_size == MINIMAP_SIZE:
+        surface.blit(minimap_layer, map_pos)
+    else:
+        surface.blit(pygame.transform.scale(minimap_layer, (map_size, map_size)), map_pos)
+
+    # Draw markers straight onto the screen, clipped to the minimap
+    previous_clip = surface.get_clip()
+    surface.set_clip(pygame.Rect(map_pos, (map_size, map_size)))
+    left, top = map_pos
+
+    # Draw enemies in the active chunks on minimap
+    active = chunks.active_enemies(enemies)
+    for ex, ey in zip((enemies.x[active] / TILE_SIZE * tile_size).tolist(), (enemies.y[active] / TILE_SIZE * tile_size).tolist()):
+        pygame.draw.circle(surface, RED, (left + int(ex), top + int(ey)), int(tile_size / 3))
+
     # Draw player on minimap
     px = player_x / TILE_SIZE * tile_size
     py = player_y / TILE_SIZE * tile_size
-    pygame.draw.circle(minimap, GREEN, (int(px), int(py)), int(tile_size / 2))
-    
+    pygame.draw.circle(surface, GREEN, (left + int(px), top + int(py)), int(tile_size / 2))
+
     # Draw player direction
-    dx = math.cos(to_radians(player_angle)) * tile_size
-    dy = math.sin(to_radians(player_angle)) * tile_size
-    pygame.draw.line(minimap, GREEN, (int(px), int(py)), (int(px + dx), int(py + dy)), 2)
-    
-    # Draw minimap on screen
-    screen.blit(minimap, map_pos)
+    dir_x, dir_y = heading_vector(player_angle)
+    dx = dir_x * tile_size
+    dy = dir_y * tile_size
+    pygame.draw.line(surface, GREEN, (left + int(px), top + int(py)), (left + int(px + dx), top + int(py + dy)),
+                     max(1, round(2 * scale)))
+
+    surface.set_clip(previous_clip)
 
 # Interact with map objects
 def interact():
@@ -699,47 +2071,40 @@ def interact():
     
     # Check for door in front of player
     check_dist = TILE_SIZE * 1.5
-    check_x = player_x + math.cos(to_radians(player_angle)) * check_dist
-    check_y = player_y + math.sin(to_radians(player_angle)) * check_dist
+    dir_x, dir_y = heading_vector(player_angle)
+    check_x = player_x + dir_x * check_dist
+    check_y = player_y + dir_y * check_dist
     
     map_x = int(check_x // TILE_SIZE)
     map_y = int(check_y // TILE_SIZE)
     
     # Check if coordinates are valid
-    if 0 <= map_x < len(MAP[0]) and 0 <= map_y < len(MAP):
+    rows, cols = MAP.shape
+    if 0 <= map_x < cols and 0 <= map_y < rows:
         # Check for door
-        if MAP[map_y][map_x] == 2:
+        if MAP[map_y, map_x] == 2:
             # Toggle door
             door_key = f"{map_x},{map_y}"
             door_opening[door_key] = 60  # Door animation frames
-            try:
-                door_sound.play()
-            except:
-                pass
+            play_sound("door_sound")
     
     # Check for items at player position
     player_map_x = int(player_x // TILE_SIZE)
     player_map_y = int(player_y // TILE_SIZE)
     
-    if 0 <= player_map_x < len(MAP[0]) and 0 <= player_map_y < len(MAP):
-        map_item = MAP[player_map_y][player_map_x]
+    if 0 <= player_map_x < cols and 0 <= player_map_y < rows:
+        map_item = MAP[player_map_y, player_map_x]
         
         if map_item == 3:  # Health pack
             player_health = min(player_max_health, player_health + 25)
-            MAP[player_map_y][player_map_x] = 0  # Remove item
-            try:
-                pickup_sound.play()
-            except:
-                pass
+            set_map_cell(player_map_x, player_map_y, 0)  # Remove item
+            play_sound("pickup_sound")
         elif map_item == 4:  # Ammo
             pistol_ammo += 20
             shotgun_ammo += 5
             bfg_ammo += 1
-            MAP[player_map_y][player_map_x] = 0  # Remove item
-            try:
-                pickup_sound.play()
-            except:
-                pass
+            set_map_cell(player_map_x, player_map_y, 0)  # Remove item
+            play_sound("pickup_sound")
 
 # Update door animations
 def update_doors():
@@ -754,10 +2119,10 @@ def update_doors():
             
             if frames == 0:
                 # Toggle door state
-                if MAP[y][x] == 2:  # If door is closed
-                    MAP[y][x] = 0  # Open it
+                if MAP[y, x] == 2:  # If door is closed
+                    set_map_cell(x, y, 0)  # Open it
                 else:  # If door is open
-                    MAP[y][x] = 2  # Close it
+                    set_map_cell(x, y, 2)  # Close it
                 doors_to_remove.append(door_key)
     
     # Remove completed door animations
@@ -774,7 +2139,7 @@ def game_over():
     text = font.render("GAME OVER", True, RED)
     screen.blit(text, (WIDTH // 2 - text.get_width() // 2, HEIGHT // 2 - text.get_height() // 2))
     
-    restart_text = hud_font.render("Press R to restart", True, WHITE)
+    restart_text = assets["hud_font"].render("Press R to restart", True, WHITE)
     screen.blit(restart_text, (WIDTH // 2 - restart_text.get_width() // 2, HEIGHT // 2 + 50))
     
     pygame.display.flip()
@@ -800,9 +2165,7 @@ def restart_game():
     global current_weapon, is_firing, firing_frame, door_opening, enemies
     
     # Reset player
-    player_x = TILE_SIZE * 1.5
-    player_y = TILE_SIZE * 1.5
-    player_angle = 0
+    player_x, player_y, player_angle = PLAYER_START
     player_health = 100
     pistol_ammo = 50
     shotgun_ammo = 20
@@ -814,28 +2177,38 @@ def restart_game():
     # Reset doors
     door_opening = {}
     
-    # Reset enemies
-    enemies = [
-        Enemy(TILE_SIZE * 8.5, TILE_SIZE * 2.5),
-        Enemy(TILE_SIZE * 14.5, TILE_SIZE * 8.5),
-        Enemy(TILE_SIZE * 12.5, TILE_SIZE * 13.5),
-        Enemy(TILE_SIZE * 3.5, TILE_SIZE * 9.5),
-        Enemy(TILE_SIZE * 9.5, TILE_SIZE * 14.5)
-    ]
+    # Reset enemies and the active chunks
+    enemies = EnemyStore(ENEMY_SPAWNS)
+    chunks.reset()
+    chunks.update(player_x, player_y)
     
     # Reset map items
-    # Restore health packs and ammo
-    for y in range(len(MAP)):
-        for x in range(len(MAP[0])):
-            if MAP[y][x] == 0:  # Check if it's an empty space now
-                # Check original map for items
-                if (x, y) in [(4, 2), (13, 2), (2, 12)]:  # Health pack positions
-                    MAP[y][x] = 3
-                elif (x, y) in [(12, 7), (11, 9)]:  # Ammo positions
-                    MAP[y][x] = 4
+    # Restore health packs and ammo that were picked up
+    for (x, y), item in list(pristine_cells.items()):
+        if item in PICKUP_ITEMS and MAP[y, x] == 0:
+            set_map_cell(x, y, item)
     
     return True
 
+# Make a loaded level current: swap in its map, rebuild everything derived
+# from the map and restart the game on it
+def set_level(level):
+    global MAP, MAP_WIDTH, MAP_HEIGHT, PLAYER_START, ENEMY_SPAWNS, minimap_layer, pvs, flow_field, map_version
+    MAP = level.grid
+    map_version += 1
+    MAP_WIDTH = MAP.shape[1] * TILE_SIZE
+    MAP_HEIGHT = MAP.shape[0] * TILE_SIZE
+    PLAYER_START = tuple(level.start)
+    ENEMY_SPAWNS = list(level.spawns)
+
+    minimap_layer = None
+    minimap_dirty_tiles.clear()
+    pristine_cells.clear()
+    pvs = PotentiallyVisibleSet(level.pvs)
+    flow_field = FlowField()
+    build_pickup_index()
+    restart_game()
+
 def draw_pause_menu():
     overlay = pygame.Surface((WIDTH, HEIGHT), pygame.SRCALPHA)
     overlay.fill((0, 0, 0, 128))  # Semi-transparent black
@@ -852,125 +2225,1028 @@ def draw_pause_menu():
     screen.blit(resume_text, (WIDTH // 2 - resume_text.get_width() // 2, HEIGHT // 2))
     screen.blit(exit_text, (WIDTH // 2 - exit_text.get_width() // 2, HEIGHT // 2 + 40))
 
-# Исправленная главная функция
-def main_game():
+# Player input for one simulation tick: held movement keys, mouse turn in
+# degrees and one-shot actions (fire, weapon switch, interact, and restart
+# after game over, which only replays use)
+TickInput = namedtuple(
+    "TickInput",
+    ["forward", "back", "strafe_left", "strafe_right", "turn_left", "turn_right", "sprint",
+     "mouse_turn", "fire", "weapon", "interact", "restart"],
+    defaults=(False, False, False, False, False, False, False, 0.0, False, None, False, False),
+)
+
+# Simulation runs at a fixed rate, independent of the render frame rate
+SIM_RATE = 60  # Simulation ticks per second
+SIM_STEP = 1 / SIM_RATE
+MAX_SIM_STEPS = 5  # Catch-up ticks per rendered frame before the game slows down
+RENDER_FPS = 60  # Render frame cap, 0 for uncapped
+
+# Advance the game by one simulation tick
+def simulate_tick(tick):
     global player_x, player_y, player_angle, player_health, current_weapon, player_speed
+
+    # One-shot actions
+    if tick.restart:
+        restart_game()
+    if tick.weapon:
+        current_weapon = tick.weapon
+    if tick.interact:
+        interact()
+    if tick.fire:
+        player_fire()
+    player_speed = 6 if tick.sprint else 3  # Sprint
+
+    # Move player along the heading (strafing along its perpendicular)
+    dir_x, dir_y = heading_vector(player_angle)
+    if tick.forward:
+        dx = dir_x * player_speed
+        dy = dir_y * player_speed
+        if not is_wall(player_x + dx, player_y):
+            player_x += dx
+        if not is_wall(player_x, player_y + dy):
+            player_y += dy
+    if tick.back:
+        dx = dir_x * player_speed
+        dy = dir_y * player_speed
+        if not is_wall(player_x - dx, player_y):
+            player_x -= dx
+        if not is_wall(player_x, player_y - dy):
+            player_y -= dy
+    if tick.strafe_left:
+        dx = dir_y * player_speed
+        dy = -dir_x * player_speed
+        if not is_wall(player_x + dx, player_y):
+            player_x += dx
+        if not is_wall(player_x, player_y + dy):
+            player_y += dy
+    if tick.strafe_right:
+        dx = -dir_y * player_speed
+        dy = dir_x * player_speed
+        if not is_wall(player_x + dx, player_y):
+            player_x += dx
+        if not is_wall(player_x, player_y + dy):
+            player_y += dy
+
+    # Rotate player
+    if tick.turn_left:
+        player_angle = (player_angle - rotation_speed) % 360
+    if tick.turn_right:
+        player_angle = (player_angle + rotation_speed) % 360
+    player_angle = (player_angle + tick.mouse_turn) % 360
+
+    # Update doors
+    update_doors()
+
+    # Update enemies and check for attacks
+    attacks = update_enemies(player_x, player_y)
+    if attacks:
+        player_health -= 10 * attacks
+        play_sound("pain_sound")
+
+    update_weapon()
+
+# Recorded sessions: a header, then per tick the input and the state hash
+# after the tick, as a zlib-compressed table. Replaying the inputs from the
+# same seed on the same level reproduces the session exactly.
+REPLAY_MAGIC = b"DREC"
+REPLAY_VERSION = 1
+REPLAY_HEADER = np.dtype([
+    ("magic", "S4"), ("version", "<u2"), ("tick_rate", "<u2"),
+    ("seed", "<u8"), ("level_crc", "<u4"), ("tick_count", "<u4"),
+])
+INPUT_ROW = np.dtype([("buttons", "<u2"), ("weapon", "u1"), ("mouse_turn", "<f8")])  # One TickInput
+REPLAY_TICK = np.dtype(INPUT_ROW.descr + [("state_hash", "<u8")])
+REPLAY_BUTTONS = ("forward", "back", "strafe_left", "strafe_right", "turn_left", "turn_right", "sprint",
+                  "fire", "interact", "restart")  # Bit order in "buttons"
+WEAPONS = (None, "pistol", "shotgun", "bfg")  # Codes for "weapon"
+
+# A loaded recording: seed, CRC of the level it started on and the tick table
+Recording = namedtuple("Recording", ["seed", "level_crc", "ticks"])
+
+# Put the game in the state every recorded session starts from: the level as
+# it loaded, the player and enemies at their starts and the RNG seeded
+def start_session(seed):
+    global session_map_version
+    restore_map()
+    rng.seed(seed)
+    restart_game()
+    session_map_version = map_version
+
+session_map_version = 0  # map_version when the session started
+
+def level_crc():
+    return zlib.crc32(np.ascontiguousarray(MAP))
+
+# 64-bit hash of the simulation state that inputs can affect
+def state_hash():
+    digest = hashlib.blake2b(digest_size=8)
+    digest.update(np.array([player_x, player_y, player_angle]).tobytes())
+    digest.update(repr((player_health, pistol_ammo, shotgun_ammo, bfg_ammo, current_weapon, firing_frame,
+                        map_version - session_map_version, sorted(door_opening.items()))).encode())
+    for values in (enemies.x, enemies.y, enemies.health, enemies.state, enemies.dead):
+        digest.update(values.tobytes())
+    return int.from_bytes(digest.digest(), "little")
+
+def save_recording(path, recording):
+    header = np.zeros(1, dtype=REPLAY_HEADER)
+    header["magic"] = REPLAY_MAGIC
+    header["version"] = REPLAY_VERSION
+    header["tick_rate"] = SIM_RATE
+    header["seed"] = recording.seed
+    header["level_crc"] = recording.level_crc
+    header["tick_count"] = len(recording.ticks)
+    with open(path, "wb") as f:
+        f.write(header.tobytes())
+        f.write(zlib.compress(np.ascontiguousarray(recording.ticks, dtype=REPLAY_TICK).tobytes()))
+
+def load_recording(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    header = np.frombuffer(data[:REPLAY_HEADER.itemsize], dtype=REPLAY_HEADER)
+    if header.size == 0 or header["magic"][0] != REPLAY_MAGIC:
+        raise ValueError(f"{path} is not a recording")
+    if header["version"][0] != REPLAY_VERSION:
+        raise ValueError(f"{path} has unsupported recording version {header['version'][0]}")
+    if header["tick_rate"][0] != SIM_RATE:
+        raise ValueError(f"{path} was recorded at {header['tick_rate'][0]} ticks per second, not {SIM_RATE}")
+    try:
+        ticks = np.frombuffer(zlib.decompress(data[REPLAY_HEADER.itemsize:]), dtype=REPLAY_TICK)
+    except (zlib.error, ValueError):
+        raise ValueError(f"{path} is damaged") from None
+    if len(ticks) != header["tick_count"][0]:
+        raise ValueError(f"{path} is truncated")
+    return Recording(int(header["seed"][0]), int(header["level_crc"][0]), ticks)
+
+# A TickInput as an INPUT_ROW tuple
+def tick_row(tick):
+    buttons = sum(1 << bit for bit, name in enumerate(REPLAY_BUTTONS) if getattr(tick, name))
+    return buttons, WEAPONS.index(tick.weapon), tick.mouse_turn
+
+# Turn a table of INPUT_ROW (or REPLAY_TICK) rows back into TickInputs
+def recorded_inputs(ticks):
+    held = [((ticks["buttons"] >> bit) & 1).astype(bool).tolist() for bit in range(len(REPLAY_BUTTONS))]
+    weapons = [WEAPONS[code] for code in ticks["weapon"].tolist()]
+    for index, mouse_turn in enumerate(ticks["mouse_turn"].tolist()):
+        buttons = {name: held[bit][index] for bit, name in enumerate(REPLAY_BUTTONS)}
+        yield TickInput(mouse_turn=mouse_turn, weapon=weapons[index], **buttons)
+
+# Logs the input of every simulated tick, and the state hash after it
+class InputRecorder:
+    def __init__(self, seed):
+        self.seed = seed
+        self.level_crc = level_crc()
+        self.rows = []
+        self.restart_pending = False
+
+    def record(self, tick):
+        buttons, weapon, mouse_turn = tick_row(tick)
+        if self.restart_pending:
+            # The game over screen restarted the game before this tick
+            buttons |= 1 << REPLAY_BUTTONS.index("restart")
+            self.restart_pending = False
+        self.rows.append((buttons, weapon, mouse_turn, state_hash()))
+
+    def restarted(self):
+        self.restart_pending = True
+
+    def save(self, path):
+        save_recording(path, Recording(self.seed, self.level_crc, np.array(self.rows, dtype=REPLAY_TICK)))
+
+# Replay a recording headlessly, as fast as the simulation runs. With verify,
+# stops at the first tick whose state hash differs from the recorded one.
+def run_replay(path, verify=True):
+    recording = load_recording(path)
+    start_session(recording.seed)
+    if level_crc() != recording.level_crc:
+        raise ValueError(f"{path} was recorded on a different level")
+
+    inputs = list(recorded_inputs(recording.ticks))
+    hashes = recording.ticks["state_hash"].tolist()
+    diverged = None
+    start = time.perf_counter()
+    for index, tick in enumerate(inputs):
+        simulate_tick(tick)
+        if verify and state_hash() != hashes[index]:
+            diverged = index
+            break
+    elapsed = time.perf_counter() - start
+
+    ticks = len(inputs) if diverged is None else diverged + 1
+    print(f"replayed {ticks} ticks in {elapsed:.3f} s ({ticks / max(elapsed, 1e-9):.0f} ticks/s)")
+    if diverged is not None:
+        print(f"state diverged from the recording at tick {diverged}")
+    elif verify:
+        print("state matched the recording on every tick")
+    return diverged is None
+
+# Scripted input for headless runs: face and shoot the nearest awake enemy
+# in line of sight, otherwise walk forward and turn away from walls by a seeded random angle,
+# trying doors and pickups once a second. Reads the live game state, so
+# consume it one tick at a time.
+def soak_inputs(seed=0):
+    script_rng = random.Random(seed)
+    turn = 0.0
+    for tick in itertools.count():
+        targets = np.nonzero(enemies.awake & ~enemies.dead)[0]
+        if targets.size:
+            dx = enemies.x[targets] - player_x
+            dy = enemies.y[targets] - player_y
+            nearest = np.argmin(dx * dx + dy * dy)
+            bearing = math.degrees(math.atan2(dy[nearest], dx[nearest]))
+            if cast_ray(bearing)[0] > math.hypot(dx[nearest], dy[nearest]):
+                offset = (bearing - player_angle + 180) % 360 - 180
+                turn = 0.0
+                yield TickInput(mouse_turn=max(-15.0, min(15.0, offset)), fire=abs(offset) < 3 and not is_firing)
+                continue
+
+        dir_x, dir_y = heading_vector(player_angle)
+        if turn == 0.0 and is_wall(player_x + dir_x * TILE_SIZE, player_y + dir_y * TILE_SIZE):
+            turn = script_rng.uniform(90, 270)
+        mouse_turn = min(turn, 15.0)
+        turn -= mouse_turn
+        yield TickInput(forward=turn == 0.0, mouse_turn=mouse_turn, interact=tick % SIM_RATE == 0)
+
+# Step only the game logic, with no rendering and no frame cap. inputs is
+# any iterable of TickInputs (soak_inputs(seed) by default); the run ends
+# after ticks ticks or when inputs runs out. A dead player is restarted.
+def run_simulation(ticks, inputs=None, seed=0):
+    start_session(seed)
+    if inputs is None:
+        inputs = soak_inputs(seed)
+
+    count = deaths = kills = 0
+    start = time.perf_counter()
+    for tick in itertools.islice(inputs, ticks):
+        simulate_tick(tick)
+        count += 1
+        if player_health <= 0:
+            deaths += 1
+            kills += int(enemies.dead.sum())
+            restart_game()
+    elapsed = time.perf_counter() - start
+    kills += int(enemies.dead.sum())
+
+    return {
+        "ticks": count,
+        "seconds": elapsed,
+        "ticks_per_second": count / max(elapsed, 1e-9),
+        "realtime_factor": count / SIM_RATE / max(elapsed, 1e-9),
+        "seed": seed,
+        "deaths": deaths,
+        "kills": kills,
+        "player_health": player_health,
+    }
+
+# Every module global that makes up one game: the level and what is derived
+# from it, the enemies and the player. A World owns its own set and swaps it
+# in while it runs, so any number of games can share the process, but only
+# one thread: Worlds are not thread-safe (WorldPool uses processes instead).
+WORLD_STATE = (
+    "MAP", "MAP_WIDTH", "MAP_HEIGHT", "PLAYER_START", "ENEMY_SPAWNS", "map_version", "pristine_cells",
+    "pickup_buckets", "pvs", "flow_field", "chunks",
+    "minimap_layer", "minimap_dirty_tiles", "minimap_columns", "minimap_rows",
+    "enemies", "door_opening", "rng", "session_map_version",
+    "player_x", "player_y", "player_angle", "player_speed", "player_health",
+    "pistol_ammo", "shotgun_ammo", "bfg_ammo", "current_weapon", "is_firing", "firing_frame",
+)
+
+world_stack = []  # Worlds swapped in, innermost last
+outside_state = {}  # The globals from before the outermost world was entered
+
+# One game instance. The world plays on level.grid itself (a copy of the
+# built-in map by default), so give each world its own grid. Use it as a
+# context manager to make it the current game, or call step(). Worlds can
+# be entered inside each other, the same one included.
+class World:
+    def __init__(self, level=None, seed=0):
+        if level is None:
+            level = BUILTIN_LEVEL._replace(grid=BUILTIN_LEVEL.grid.copy())
+        self.state = {
+            "pickup_buckets": {}, "minimap_dirty_tiles": set(), "pristine_cells": {},
+            "chunks": ChunkManager(), "door_opening": {}, "rng": random.Random(), "player_speed": 3,
+        }
+        with self:
+            set_level(level)
+            start_session(seed)
+
+    def __enter__(self):
+        global outside_state
+        module = globals()
+        running = {name: module[name] for name in WORLD_STATE}
+        if world_stack:
+            world_stack[-1].state = running  # Suspend the running world, which may be this one
+        else:
+            outside_state = running
+        world_stack.append(self)
+        module.update(self.state)
+        return self
+
+    def __exit__(self, *exc_info):
+        module = globals()
+        self.state = {name: module[name] for name in WORLD_STATE}
+        world_stack.pop()
+        module.update(world_stack[-1].state if world_stack else outside_state)
+
+    def step(self, tick):
+        with self:
+            simulate_tick(tick)
+
+# The enemies of every world in a WorldBatch as one EnemyStore. Each array
+# is the (worlds, enemies per world) stack flattened, and every world's own
+# store is rebound to views of its rows, so one update() moves the enemies
+# of all worlds. Walls, paths and spatial hashes are looked up per world.
+ENEMY_ARRAYS = ("x", "y", "health", "angle", "speed", "state", "attack_cooldown", "hit_cooldown",
+                "dead", "awake", "prev_x", "prev_y", "tile_x", "tile_y")
+
+class EnemyBatch(EnemyStore):
+    def __init__(self, batch):
+        self.batch = batch
+        self.stores = [world.state["enemies"] for world in batch.worlds]
+        self.per_world = len(self.stores[0])
+        for name in ENEMY_ARRAYS:
+            setattr(self, name, np.concatenate([getattr(store, name) for store in self.stores]))
+        for index, store in enumerate(self.stores):
+            self.adopt(index, store)
+
+    # Make store the enemies of world index, e.g. after a restart replaced them
+    def adopt(self, index, store):
+        rows = slice(index * self.per_world, (index + 1) * self.per_world)
+        for name in ENEMY_ARRAYS:
+            view = getattr(self, name)[rows]
+            view[:] = getattr(store, name)
+            setattr(store, name, view)
+        self.stores[index] = store
+
+    def walls(self, indices, xs, ys):
+        return self.batch.walls(indices // self.per_world, xs, ys)
+
+    def next_tiles(self, indices, flow):
+        return flow.next_tiles(indices // self.per_world, self.tile_x[indices], self.tile_y[indices])
+
+    def refile(self, index, old_tile, new_tile):
+        self.stores[index // self.per_world].refile(index % self.per_world, old_tile, new_tile)
+
+    # Attacks per world
+    def attacks(self, attackers):
+        return np.bincount(attackers // self.per_world, minlength=len(self.stores))
+
+# N worlds on one level stepped in lockstep, like a vectorized environment.
+# step() takes one input per world (TickInputs or an INPUT_ROW array) and
+# returns the state of every world stacked along the first axis; a world
+# whose player died reports done and is restarted. The maps are slices of
+# one stacked (N, rows, cols) array and the enemies rows of one EnemyBatch.
+# A step runs simulate_tick() for all worlds at once: the player, weapons,
+# doors, enemies and flow fields are updated as arrays over every world,
+# and only rare events (restarts, resolving shots, map changes) run world by
+# world. The batch's arrays hold the players and door animations; the
+# worlds' own state only catches up in those events or on push(), so push()
+# before entering or reading a world, and pull() after changing one. The
+# batch makes no sound.
+class WorldBatch:
+    def __init__(self, count, level=None, seed=0):
+        level = level or BUILTIN_LEVEL
+        self.maps = np.repeat(np.asarray(level.grid)[None], count, axis=0)
+
+        # Walls and doors sit in the same places in every world, so they
+        # share one PVS table
+        if level.pvs is None:
+            level = level._replace(pvs=PvsTable(level.grid.copy()))
+        self.table = level.pvs
+        self.worlds = [World(level._replace(grid=self.maps[index]), seed + index) for index in range(count)]
+        self.enemies = EnemyBatch(self)
+
+        # Door animation frames per world and door of the level
+        rows, cols = self.maps.shape[1:]
+        self.door_cells = [(int(door) % cols, int(door) // cols) for door in level.pvs.doors]
+        self.door_slots = np.full((rows, cols), -1, dtype=np.int64)
+        self.door_slots.flat[level.pvs.doors] = np.arange(len(level.pvs.doors))
+        self.door_timers = np.zeros((count, len(self.door_cells)), dtype=np.int64)
+
+        # Player state
+        self.x = np.zeros(count)
+        self.y = np.zeros(count)
+        self.angle = np.zeros(count)
+        self.health = np.zeros(count, dtype=np.int64)
+        self.speed = np.zeros(count, dtype=np.int64)
+        self.ammo = np.zeros((count, 3), dtype=np.int64)  # Pistol, shotgun, BFG
+        self.weapon = np.zeros(count, dtype=np.uint8)  # Index in WEAPONS
+        self.firing = np.zeros(count, dtype=bool)
+        self.firing_frame = np.zeros(count, dtype=np.int64)
+
+        # What update_enemies() takes from each world's chunks, PVS and flow
+        # field, refreshed when its player changes tiles or its map changes:
+        # the active chunks, the potentially visible tiles in a window around
+        # the player's tile and the flow field, a window centred on the tile
+        radius = level.pvs.radius
+        side = 2 * FLOW_RADIUS + 1
+        self.map_versions = np.zeros(count, dtype=np.int64)
+        self.cache_keys = np.full((count, 3), -1, dtype=np.int64)  # Player tile and map_version
+        self.active_chunks = np.zeros((count, 4), dtype=np.int64)  # first_x, first_y, end_x, end_y
+        self.visible = np.zeros((count, 2 * radius + 1, 2 * radius + 1), dtype=bool)
+        self.flow_bounds = np.zeros((count, 4), dtype=np.int64)
+        self.flow_distance = np.zeros((count, side, side), dtype=np.int32)
+        self.flow_next_x = np.zeros((count, side, side), dtype=np.int64)
+        self.flow_next_y = np.zeros((count, side, side), dtype=np.int64)
+        self.pull(range(count))
+
+    def __len__(self):
+        return len(self.worlds)
+
+    def step(self, inputs):
+        if len(inputs) != len(self.worlds):
+            raise ValueError(f"got {len(inputs)} inputs for {len(self.worlds)} worlds")
+        if not isinstance(inputs, np.ndarray):
+            inputs = np.array([tick_row(tick) for tick in inputs], dtype=INPUT_ROW)
+        held = {name: (inputs["buttons"] >> bit & 1).astype(bool) for bit, name in enumerate(REPLAY_BUTTONS)}
+        everyone = np.arange(len(self.worlds))
+
+        # One-shot actions
+        for index in np.flatnonzero(held["restart"]).tolist():
+            self.run(index, restart_game)
+        self.weapon = np.where(inputs["weapon"] > 0, inputs["weapon"], self.weapon)
+        dir_x, dir_y = np.array([heading_vector(angle) for angle in self.angle.tolist()]).reshape(-1, 2).T
+        self.interact(held["interact"], dir_x, dir_y)
+        self.fire(held["fire"])
+        self.speed = np.where(held["sprint"], 6, 3)
+
+        # Move players along their heading (strafing along its perpendicular)
+        for name, step_x, step_y in (("forward", dir_x, dir_y), ("back", -dir_x, -dir_y),
+                                     ("strafe_left", dir_y, -dir_x), ("strafe_right", -dir_y, dir_x)):
+            dx = step_x * self.speed
+            dy = step_y * self.speed
+            moved = held[name] & ~self.walls(everyone, self.x + dx, self.y)
+            self.x = np.where(moved, self.x + dx, self.x)
+            moved = held[name] & ~self.walls(everyone, self.x, self.y + dy)
+            self.y = np.where(moved, self.y + dy, self.y)
+
+        # Rotate players
+        self.angle = np.where(held["turn_left"], (self.angle - rotation_speed) % 360, self.angle)
+        self.angle = np.where(held["turn_right"], (self.angle + rotation_speed) % 360, self.angle)
+        self.angle = (self.angle + inputs["mouse_turn"]) % 360
+
+        # Update doors, toggling those whose animation ended
+        opening = self.door_timers > 0
+        self.door_timers -= opening
+        for index, slot in zip(*(part.tolist() for part in np.nonzero(opening & (self.door_timers == 0)))):
+            map_x, map_y = self.door_cells[slot]
+            with self.worlds[index]:
+                set_map_cell(map_x, map_y, 0 if MAP[map_y, map_x] == 2 else 2)
+                self.map_versions[index] = map_version
+
+        # Update enemies, then the weapon animation
+        self.health -= 10 * self.update_enemies()
+        self.firing_frame -= self.firing
+        self.firing &= self.firing_frame > 0
+
+        # Restart the worlds whose player died
+        done = self.health <= 0
+        for index in np.flatnonzero(done).tolist():
+            self.run(index, restart_game)
+        observation = self.observe()
+        observation["done"] = done
+        return observation
+
+    def observe(self):
+        shape = (len(self.worlds), self.enemies.per_world)
+        return {
+            "player": np.column_stack([self.x, self.y, self.angle, self.health]),
+            "ammo": self.ammo.copy(),
+            "weapon": self.weapon.copy(),
+            "enemy_x": self.enemies.x.reshape(shape).copy(),
+            "enemy_y": self.enemies.y.reshape(shape).copy(),
+            "enemy_health": self.enemies.health.reshape(shape).copy(),
+            "enemy_dead": self.enemies.dead.reshape(shape).copy(),
+            "maps": self.maps,
+        }
+
+    # Read the player, door animations and enemies of the worlds at indices
+    # (all by default) into the batch
+    def pull(self, indices=None):
+        indices = np.arange(len(self.worlds)) if indices is None else np.asarray(indices, dtype=np.int64)
+        states = [self.worlds[index].state for index in indices.tolist()]
+        self.x[indices], self.y[indices], self.angle[indices] = np.array(
+            [[state["player_x"], state["player_y"], state["player_angle"]] for state in states], dtype=np.float64
+        ).reshape(-1, 3).T
+        self.health[indices], self.speed[indices], self.firing_frame[indices] = np.array(
+            [[state["player_health"], state["player_speed"], state["firing_frame"]] for state in states], dtype=np.int64
+        ).reshape(-1, 3).T
+        self.ammo[indices] = np.array([[state["pistol_ammo"], state["shotgun_ammo"], state["bfg_ammo"]]
+                                       for state in states], dtype=np.int64).reshape(-1, 3)
+        self.weapon[indices] = [WEAPONS.index(state["current_weapon"]) for state in states]
+        self.firing[indices] = [state["is_firing"] for state in states]
+        self.map_versions[indices] = [state["map_version"] for state in states]
+        self.door_timers[indices] = 0
+        for index, state in zip(indices.tolist(), states):
+            for door_key, frames in state["door_opening"].items():
+                map_x, map_y = map(int, door_key.split(","))
+                self.door_timers[index, self.door_slots[map_y, map_x]] = frames
+            if state["enemies"] is not self.enemies.stores[index]:
+                self.enemies.adopt(index, state["enemies"])
+
+    # Write the batch's player and door animations back to the worlds at
+    # indices (all by default), and move their active chunks with the player
+    def push(self, indices=None):
+        indices = np.arange(len(self.worlds)) if indices is None else np.asarray(indices, dtype=np.int64)
+        rows = zip(indices.tolist(), self.x[indices].tolist(), self.y[indices].tolist(), self.angle[indices].tolist(),
+                   self.health[indices].tolist(), self.speed[indices].tolist(), self.ammo[indices].tolist(),
+                   self.weapon[indices].tolist(), self.firing[indices].tolist(), self.firing_frame[indices].tolist(),
+                   self.door_timers[indices].any(axis=1).tolist())
+        for index, x, y, angle, health, speed, ammo, weapon, firing, firing_frame, doors in rows:
+            state = self.worlds[index].state
+            state.update(player_x=x, player_y=y, player_angle=angle, player_health=health, player_speed=speed,
+                         pistol_ammo=ammo[0], shotgun_ammo=ammo[1], bfg_ammo=ammo[2], current_weapon=WEAPONS[weapon],
+                         is_firing=firing, firing_frame=firing_frame)
+            state["chunks"].update(x, y, self.maps.shape[1:])
+            if doors or state["door_opening"]:
+                state["door_opening"] = {f"{self.door_cells[slot][0]},{self.door_cells[slot][1]}": frames
+                                         for slot, frames in enumerate(self.door_timers[index].tolist()) if frames}
+
+    # Call function in world index with the batch's state for it
+    def run(self, index, function):
+        self.push([index])
+        with self.worlds[index]:
+            function()
+        self.pull([index])
+
+    # Whether points are in walls, in the maps of worlds, like is_wall_array()
+    def walls(self, worlds, xs, ys):
+        map_x = np.floor_divide(xs, TILE_SIZE).astype(np.int64)
+        map_y = np.floor_divide(ys, TILE_SIZE).astype(np.int64)
+        rows, cols = self.maps.shape[1:]
+        inside = (map_x >= 0) & (map_x < cols) & (map_y >= 0) & (map_y < rows)
+        walls = np.ones(len(map_x), dtype=bool)  # Assume out of bounds is a wall
+        walls[inside] = SOLID_CELLS[self.maps[worlds[inside], map_y[inside], map_x[inside]]]
+        return walls
+
+    # interact() for the players who pressed it: start the animation of a
+    # closed door in front of them and pick up the item they stand on
+    def interact(self, pressed, dir_x, dir_y):
+        worlds = np.flatnonzero(pressed)
+        rows, cols = self.maps.shape[1:]
+        check_dist = TILE_SIZE * 1.5
+        map_x = np.floor_divide(self.x[worlds] + dir_x[worlds] * check_dist, TILE_SIZE).astype(np.int64)
+        map_y = np.floor_divide(self.y[worlds] + dir_y[worlds] * check_dist, TILE_SIZE).astype(np.int64)
+        inside = (map_x >= 0) & (map_x < cols) & (map_y >= 0) & (map_y < rows)
+        doors = inside.copy()
+        doors[inside] = self.maps[worlds[inside], map_y[inside], map_x[inside]] == 2
+        self.door_timers[worlds[doors], self.door_slots[map_y[doors], map_x[doors]]] = 60
+
+        map_x = np.floor_divide(self.x[worlds], TILE_SIZE).astype(np.int64)
+        map_y = np.floor_divide(self.y[worlds], TILE_SIZE).astype(np.int64)
+        inside = (map_x >= 0) & (map_x < cols) & (map_y >= 0) & (map_y < rows)
+        items = np.zeros(len(worlds), dtype=np.uint8)
+        items[inside] = self.maps[worlds[inside], map_y[inside], map_x[inside]]
+        health, ammo = items == 3, items == 4
+        self.health[worlds[health]] = np.minimum(player_max_health, self.health[worlds[health]] + 25)
+        self.ammo[worlds[ammo]] += (20, 5, 1)
+        taken = health | ammo
+        for index, item_x, item_y in zip(worlds[taken].tolist(), map_x[taken].tolist(), map_y[taken].tolist()):
+            with self.worlds[index]:
+                set_map_cell(item_x, item_y, 0)
+                self.map_versions[index] = map_version
+
+    # player_fire() for the players who pressed it: spend ammo and start the
+    # animation, then resolve each shot in its own world
+    def fire(self, pressed):
+        worlds = np.arange(len(self.worlds))
+        slot = self.weapon.astype(np.int64) - 1
+        fired = pressed & (self.ammo[worlds, slot] > 0)
+        self.ammo[worlds[fired], slot[fired]] -= 1
+        self.firing |= fired
+        self.firing_frame[fired] = 5
+        for index in np.flatnonzero(fired).tolist():
+            self.run(index, fire_shot)
+
+    # update_enemies() for every world; returns the attacks per world
+    def update_enemies(self):
+        self.refresh()
+        enemies = self.enemies
+        owner = np.arange(len(enemies)) // max(enemies.per_world, 1)
+        alive = ~enemies.dead
+
+        # Wake the living enemies in tiles potentially visible from their
+        # world's player
+        radius = (self.visible.shape[1] - 1) // 2
+        window_x = enemies.tile_x - self.cache_keys[owner, 0] + radius
+        window_y = enemies.tile_y - self.cache_keys[owner, 1] + radius
+        seen = alive & (window_x >= 0) & (window_x <= 2 * radius) & (window_y >= 0) & (window_y <= 2 * radius)
+        seen[seen] = self.visible[owner[seen], window_y[seen], window_x[seen]]
+        enemies.awake |= seen
+
+        # Update the awake ones in the active chunks
+        chunk_x = enemies.tile_x // CHUNK_SIZE
+        chunk_y = enemies.tile_y // CHUNK_SIZE
+        first_x, first_y, end_x, end_y = self.active_chunks[owner].T
+        active = alive & (chunk_x >= first_x) & (chunk_x < end_x) & (chunk_y >= first_y) & (chunk_y < end_y)
+        return enemies.update(self.x[owner], self.y[owner], np.flatnonzero(active & enemies.awake), self)
+
+    # Bring the active chunks, PVS windows and flow fields of the worlds whose
+    # player changed tiles or whose map changed up to date, as arrays over
+    # those worlds
+    def refresh(self):
+        tile_x = np.floor_divide(self.x, TILE_SIZE).astype(np.int64)
+        tile_y = np.floor_divide(self.y, TILE_SIZE).astype(np.int64)
+        keys = np.column_stack([tile_x, tile_y, self.map_versions])
+        changed = np.flatnonzero((keys != self.cache_keys).any(axis=1))
+        self.cache_keys = keys
+        if not changed.size:
+            return
+        tile_x, tile_y = tile_x[changed], tile_y[changed]
+        rows, cols = self.maps.shape[1:]
+
+        # The chunks within CHUNK_RADIUS of the player's, like ChunkManager
+        center_x, center_y = tile_x // CHUNK_SIZE, tile_y // CHUNK_SIZE
+        last_x, last_y = (cols - 1) // CHUNK_SIZE, (rows - 1) // CHUNK_SIZE
+        first_x = np.minimum(np.maximum(center_x - CHUNK_RADIUS, 0), last_x)
+        first_y = np.minimum(np.maximum(center_y - CHUNK_RADIUS, 0), last_y)
+        end_x = np.maximum(np.minimum(center_x + CHUNK_RADIUS, last_x), first_x) + 1
+        end_y = np.maximum(np.minimum(center_y + CHUNK_RADIUS, last_y), first_y) + 1
+        self.active_chunks[changed] = np.column_stack([first_x, first_y, end_x, end_y])
+
+        # One PVS lookup per player tile, shared by the worlds on it
+        grids = self.maps.reshape(len(self.worlds), -1)
+        tiles, group = np.unique(tile_y * cols + tile_x, return_inverse=True)
+        for number, tile in enumerate(tiles.tolist()):
+            worlds = changed[group == number]
+            self.visible[worlds] = visible_windows(self.table, tile % cols, tile // cols, grids, worlds)
+
+        # The flow field around every player, searched in one go; tiles off
+        # the map are walls
+        offsets = np.arange(-FLOW_RADIUS, FLOW_RADIUS + 1)
+        window_x = (tile_x[:, None] + offsets)[:, None, :]
+        window_y = (tile_y[:, None] + offsets)[:, :, None]
+        inside = (window_x >= 0) & (window_x < cols) & (window_y >= 0) & (window_y < rows)
+        cells = self.maps[changed[:, None, None], np.clip(window_y, 0, rows - 1), np.clip(window_x, 0, cols - 1)]
+        distance, step_x, step_y = flow_search(inside & ~SOLID_CELLS[cells], np.full(len(changed), FLOW_RADIUS),
+                                                np.full(len(changed), FLOW_RADIUS))
+        self.flow_bounds[changed] = np.column_stack([tile_x - FLOW_RADIUS, tile_y - FLOW_RADIUS,
+                                                     tile_x + FLOW_RADIUS + 1, tile_y + FLOW_RADIUS + 1])
+        self.flow_distance[changed] = distance
+        self.flow_next_x[changed] = window_x + step_x
+        self.flow_next_y[changed] = window_y + step_y
+
+    # FlowField.next_tiles() for tiles in the flow fields of worlds
+    def next_tiles(self, worlds, tiles_x, tiles_y):
+        first_x, first_y, end_x, end_y = self.flow_bounds[worlds].T
+        inside = (tiles_x >= first_x) & (tiles_x < end_x) & (tiles_y >= first_y) & (tiles_y < end_y)
+        local_x = np.where(inside, tiles_x - first_x, 0)
+        local_y = np.where(inside, tiles_y - first_y, 0)
+        on_path = inside & (self.flow_distance[worlds, local_y, local_x] > 0)
+        return self.flow_next_x[worlds, local_y, local_x], self.flow_next_y[worlds, local_y, local_x], on_path
+
+# Render the current game offscreen; no window is needed. Draws into surface
+# (a new 32-bit surface of the given size by default), casting one ray per
+# column, and returns a (height, width, 3) view of its pixels, not a copy.
+# The surface stays locked while the view is alive, so drop it before
+# rendering into the same surface again. The HUD, weapon and minimap can be
+# left out; with depth, the distance to the wall in every pixel column is
+# returned too. view is an (x, y, angle) camera, the player's by default;
+# rays from another camera cover the chunks around it, as if the player
+# stood there.
+def render_to_array(size=(WIDTH, HEIGHT), surface=None, hud=True, weapon=True, minimap=True, depth=False,
+                    view=None):
+    if surface is None:
+        surface = pygame.Surface(size, 0, 32)
+    if hud and not pygame.font.get_init():
+        pygame.font.init()
+    view_x, view_y, view_angle = view or (player_x, player_y, player_angle)
+    tile_bounds = None
+    if view is not None:
+        camera_chunks = ChunkManager()
+        camera_chunks.update(view_x, view_y)
+        tile_bounds = camera_chunks.bounds
+
+    column_depth = draw_scene(view_x, view_y, view_angle, surface=surface, rays=surface.get_width(),
+                              tile_bounds=tile_bounds)
+    if weapon:
+        draw_weapon(surface)
+    if hud:
+        draw_hud(surface)
+    if minimap:
+        draw_minimap(view_x, view_y, view_angle, surface)
+
+    frame = pygame.surfarray.pixels3d(surface).swapaxes(0, 1)
+    return (frame, column_depth) if depth else frame
+
+# Worlds spread over worker processes. Every worker hosts a WorldBatch for
+# a slice of the worlds and renders their frames (size is width, height;
+# overlays adds the HUD, weapon and minimap) into one shared memory block,
+# which the parent reads as a (count, height, width, 3) array without
+# copying; only inputs and the small per-world state go through the pipes.
+# The frames are overwritten by the next step(), so copy any you keep.
+POOL_JOIN_SECONDS = 5.0  # Wait for a worker to exit before terminating it
+
+class WorldPool:
+    def __init__(self, count, level=None, seed=0, workers=None, render=True, size=(WIDTH, HEIGHT), overlays=True):
+        workers = max(1, min(count, workers or os.cpu_count() or 1))
+        shape = (count, size[1], size[0], 3) if render else (count, 0, 0, 3)
+        self.memory = shared_memory.SharedMemory(create=True, size=max(1, math.prod(shape)))
+        self.frames = np.ndarray(shape, dtype=np.uint8, buffer=self.memory.buf)
+        bounds = np.linspace(0, count, workers + 1).astype(int).tolist()
+        self.slices = [slice(first, end) for first, end in zip(bounds, bounds[1:])]
+
+        # Spawned workers start from a fresh interpreter, not a copy of this
+        # process's pygame state
+        context = multiprocessing.get_context("spawn")
+        self.connections = []
+        self.processes = []
+        try:
+            for part in self.slices:
+                parent_end, child_end = context.Pipe()
+                self.connections.append(parent_end)
+                process = context.Process(target=pool_worker, daemon=True,
+                                          args=(child_end, self.memory.name, self.frames.shape, part, level, seed,
+                                                render, overlays))
+                process.start()
+                child_end.close()
+                self.processes.append(process)
+            self.observation = self.gather()
+        except BaseException:
+            # A worker failed to start or to build its worlds: stop the
+            # others and release the shared memory before re-raising
+            self.close()
+            raise
+
+    def __len__(self):
+        return self.slices[-1].stop
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Same inputs and state as WorldBatch.step(); returns (frames, state)
+    def step(self, inputs):
+        if self.memory is None:
+            raise ValueError("WorldPool is closed")
+        if not isinstance(inputs, np.ndarray):
+            inputs = np.array([tick_row(tick) for tick in inputs], dtype=INPUT_ROW)
+        if len(inputs) != len(self):
+            raise ValueError(f"got {len(inputs)} inputs for {len(self)} worlds")
+        for connection, part in zip(self.connections, self.slices):
+            connection.send(("step", inputs[part]))
+        self.observation = self.gather()
+        return self.frames, self.observation
+
+    def gather(self):
+        replies = [connection.recv() for connection in self.connections]
+        for reply in replies:
+            if isinstance(reply, Exception):
+                raise reply
+        return {key: np.concatenate([reply[key] for reply in replies]) for key in replies[0]}
+
+    # Safe to call more than once
+    def close(self):
+        if self.memory is None:
+            return
+        for connection in self.connections:
+            try:
+                connection.send(("close", None))
+            except OSError:
+                pass  # Worker already gone
+        for process in self.processes:
+            process.join(POOL_JOIN_SECONDS)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        for connection in self.connections:
+            connection.close()
+        self.connections = []
+        self.processes = []
+        self.frames = None
+        self.memory.close()
+        self.memory.unlink()
+        self.memory = None
+
+# Body of a WorldPool worker process: step and render its worlds on request
+def pool_worker(connection, memory_name, shape, part, level, seed, render, overlays):
+    memory = shared_memory.SharedMemory(name=memory_name)
+    try:
+        frames = np.ndarray(shape, dtype=np.uint8, buffer=memory.buf)[part]
+        surface = pygame.Surface((shape[2], shape[1]), 0, 32)
+        try:
+            batch = WorldBatch(part.stop - part.start, level, seed + part.start)
+        except Exception as error:
+            connection.send(error)  # Raised by the parent's first gather()
+            return
+        command, inputs = "observe", None
+        while command != "close":
+            try:
+                if command == "step":
+                    observation = batch.step(inputs)
+                else:
+                    observation = batch.observe()
+                    observation["done"] = np.zeros(len(batch), dtype=bool)
+                del observation["maps"]
+                if render:
+                    batch.push()
+                    for world, frame in zip(batch.worlds, frames):
+                        with world:
+                            frame[...] = render_to_array(surface=surface, hud=overlays, weapon=overlays,
+                                                         minimap=overlays)
+                connection.send(observation)
+            except Exception as error:
+                connection.send(error)
+            command, inputs = connection.recv()
+    finally:
+        frames = None
+        memory.close()
+
+# Picks the ray count for the next frame from recent frame costs. The count
+# only changes after a full window of samples averages outside the dead band
+# of +/- hysteresis around the budget, so it settles instead of oscillating.
+class ResolutionController:
+    def __init__(self, budget_ms=FRAME_BUDGET_MS, min_rays=MIN_RAY_COUNT, max_rays=RAY_COUNT,
+                 hysteresis=0.15, window=30, step_up=1.1):
+        self.budget_ms = budget_ms
+        self.min_rays = min_rays
+        self.max_rays = max_rays
+        self.hysteresis = hysteresis
+        self.window = window
+        self.step_up = step_up
+        self.rays = max_rays
+        self.samples = []
+
+    def update(self, frame_ms):
+        self.samples.append(frame_ms)
+        if len(self.samples) < self.window:
+            return self.rays
+
+        average = sum(self.samples) / len(self.samples)
+        self.samples = []
+        if average > self.budget_ms * (1 + self.hysteresis):
+            # Over budget: scale down in proportion to the overrun
+            self.rays = int(self.rays * max(0.5, self.budget_ms / average))
+        elif average < self.budget_ms * (1 - self.hysteresis):
+            # Well under budget: win back resolution gradually
+            self.rays = int(self.rays * self.step_up) + 1
+        self.rays = min(self.max_rays, max(self.min_rays, self.rays))
+        return self.rays
+
+# Decides what part of the screen a frame has to redraw and present. The
+# world (scene, weapon and minimap) is redrawn only when something it shows
+# changed; the HUD strip is redrawn over a saved copy of the world beneath it.
+class FramePresenter:
+    def __init__(self):
+        self.world_key = None
+        self.hud_key = None
+        self.hud_backdrop = None  # World pixels under HUD_AREA
+
+    # Force a full redraw, e.g. after an overlay covered the screen
+    def invalidate(self):
+        self.world_key = None
+        self.hud_key = None
+
+    # Everything the world layers depend on for this frame
+    def world_state(self, view_x, view_y, view_angle, alpha):
+        enemy_x, enemy_y = enemies.interpolate(alpha)
+        active = chunks.active_enemies(enemies)
+        return (view_x, view_y, view_angle, ray_count, map_version, current_weapon, is_firing, firing_frame > 3,
+                enemy_x[active].tobytes(), enemy_y[active].tobytes())
+
+    # Returns whether the scene was rendered (not just the HUD, or nothing)
+    def draw(self, view_x, view_y, view_angle, alpha):
+        world_key = self.world_state(view_x, view_y, view_angle, alpha) if DIRTY_RECTS else None
+        hud_key = hud_lines()
+        if world_key is None or world_key != self.world_key:
+            # The wall pass writes every pixel, so the screen needs no clearing
+            draw_scene(view_x, view_y, view_angle, alpha)
+            draw_weapon()
+            draw_minimap(view_x, view_y, view_angle)
+            self.hud_backdrop = screen.subsurface(HUD_AREA).copy()
+            draw_hud()
+            pygame.display.flip()
+            rendered = True
+        else:
+            if hud_key != self.hud_key:
+                screen.blit(self.hud_backdrop, HUD_AREA)
+                draw_hud()
+                pygame.display.update(HUD_AREA)
+            rendered = False
+        self.world_key = world_key
+        self.hud_key = hud_key
+        return rendered
+
+# Blend two camera poses, turning the short way round
+def interpolate_view(previous, current, alpha):
+    (x0, y0, angle0), (x1, y1, angle1) = previous, current
+    turn = (angle1 - angle0 + 180) % 360 - 180
+    return x0 + (x1 - x0) * alpha, y0 + (y1 - y0) * alpha, (angle0 + turn * alpha) % 360
+
+# Main game loop: input and rendering run once per frame, the simulation in
+# fixed SIM_STEP ticks, and the scene is drawn between the last two ticks
+def main_game(recorder=None):
+    global ray_count
     running = True
     paused = False
-    
+    resolution = ResolutionController()
+    presenter = FramePresenter()
+    pause_shown = False
+
+    # One-shot input collected from events until the next tick consumes it
+    pending = {"mouse_turn": 0.0, "fire": False, "weapon": None, "interact": False}
+    accumulator = 0.0
+    previous_view = current_view = (player_x, player_y, player_angle)
+    rendered = False  # Whether the last frame rendered the scene
+
     while running:
+        frame_time = clock.tick(RENDER_FPS) / 1000
+
+        # Adjust the internal resolution to the cost of the last frame, if it
+        # rendered the scene; skipped frames cost next to nothing and would
+        # push the ray count up
+        if DYNAMIC_RESOLUTION and rendered:
+            ray_count = resolution.update(clock.get_rawtime())
+
         # Handle events
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 running = False
+            elif event.type in (pygame.VIDEOEXPOSE, pygame.WINDOWEXPOSED, pygame.WINDOWSIZECHANGED):
+                presenter.invalidate()
+                pause_shown = False
             elif event.type == pygame.KEYDOWN:
                 if event.key == pygame.K_1:
-                    current_weapon = "pistol"
+                    pending["weapon"] = "pistol"
                 elif event.key == pygame.K_2:
-                    current_weapon = "shotgun"
+                    pending["weapon"] = "shotgun"
                 elif event.key == pygame.K_3:
-                    current_weapon = "bfg"
+                    pending["weapon"] = "bfg"
                 elif event.key == pygame.K_e:
-                    interact()
-                elif event.key == pygame.K_LSHIFT:
-                    player_speed = 6  # Sprint
+                    pending["interact"] = True
                 elif event.key == pygame.K_ESCAPE:
                     # Toggle pause
                     paused = not paused
+                    pause_shown = False
+                    presenter.invalidate()
                 elif event.key == pygame.K_q and pygame.key.get_mods() & pygame.KMOD_CTRL:
                     # Exit with Ctrl+Q
                     running = False
-            elif event.type == pygame.KEYUP:
-                if event.key == pygame.K_LSHIFT:
-                    player_speed = 3  # Normal speed
             elif event.type == pygame.MOUSEBUTTONDOWN and not paused:
                 if event.button == 1:  # Left mouse button
-                    player_fire()
-        
-        # If game is paused, display pause menu and skip game update
+                    pending["fire"] = True
+
+        # If game is paused, display pause menu (once, with dirty rects) and
+        # skip game update
         if paused:
-            draw_pause_menu()
-            pygame.display.flip()
-            clock.tick(60)
+            if not pause_shown or not DIRTY_RECTS:
+                draw_pause_menu()
+                pygame.display.flip()
+                pause_shown = True
+            rendered = False
             continue
-        
-        # Get keyboard state
-        keys = pygame.key.get_pressed()
-        
-        # Move player
-        if keys[pygame.K_w]:
-            dx = math.cos(to_radians(player_angle)) * player_speed
-            dy = math.sin(to_radians(player_angle)) * player_speed
-            if not is_wall(player_x + dx, player_y):
-                player_x += dx
-            if not is_wall(player_x, player_y + dy):
-                player_y += dy
-        if keys[pygame.K_s]:
-            dx = math.cos(to_radians(player_angle)) * player_speed
-            dy = math.sin(to_radians(player_angle)) * player_speed
-            if not is_wall(player_x - dx, player_y):
-                player_x -= dx
-            if not is_wall(player_x, player_y - dy):
-                player_y -= dy
-        if keys[pygame.K_a]:
-            strafe_angle = (player_angle - 90) % 360
-            dx = math.cos(to_radians(strafe_angle)) * player_speed
-            dy = math.sin(to_radians(strafe_angle)) * player_speed
-            if not is_wall(player_x + dx, player_y):
-                player_x += dx
-            if not is_wall(player_x, player_y + dy):
-                player_y += dy
-        if keys[pygame.K_d]:
-            strafe_angle = (player_angle + 90) % 360
-            dx = math.cos(to_radians(strafe_angle)) * player_speed
-            dy = math.sin(to_radians(strafe_angle)) * player_speed
-            if not is_wall(player_x + dx, player_y):
-                player_x += dx
-            if not is_wall(player_x, player_y + dy):
-                player_y += dy
-        
-        # Rotate player
-        if keys[pygame.K_LEFT]:
-            player_angle = (player_angle - rotation_speed) % 360
-        if keys[pygame.K_RIGHT]:
-            player_angle = (player_angle + rotation_speed) % 360
-        
+
         # Mouse look
         if pygame.mouse.get_focused():
             mouse_rel = pygame.mouse.get_rel()
-            player_angle = (player_angle + mouse_rel[0] * 0.2) % 360
+            pending["mouse_turn"] += mouse_rel[0] * 0.2
             pygame.mouse.set_pos(WIDTH // 2, HEIGHT // 2)
-        
-        # Update doors
-        update_doors()
-        
-        # Update enemies and check for attacks
-        for enemy in enemies:
-            player_hit = enemy.update(player_x, player_y)
-            if player_hit:
-                player_health -= 10
-                try:
-                    pain_sound.play()
-                except:
-                    pass
-        
-        # Check player health
-        if player_health <= 0:
-            if not game_over():
-                running = False
-        
-        # Draw everything
-        screen.fill(BLACK)
-        draw_scene()
-        draw_weapon()
-        draw_hud()
-        draw_minimap(player_x, player_y, player_angle)
-        
-        # Update display
-        pygame.display.flip()
-        
-        # Cap the frame rate
-        clock.tick(60)
+
+        # Get keyboard state
+        keys = pygame.key.get_pressed()
+        held = {
+            "forward": keys[pygame.K_w],
+            "back": keys[pygame.K_s],
+            "strafe_left": keys[pygame.K_a],
+            "strafe_right": keys[pygame.K_d],
+            "turn_left": keys[pygame.K_LEFT],
+            "turn_right": keys[pygame.K_RIGHT],
+            "sprint": keys[pygame.K_LSHIFT],
+        }
+
+        # Run as many simulation ticks as the elapsed time calls for
+        accumulator += frame_time
+        steps = 0
+        while accumulator >= SIM_STEP and steps < MAX_SIM_STEPS:
+            tick = TickInput(**held, **pending)
+            simulate_tick(tick)
+            if recorder:
+                recorder.record(tick)
+            pending = {"mouse_turn": 0.0, "fire": False, "weapon": None, "interact": False}
+            previous_view, current_view = current_view, (player_x, player_y, player_angle)
+            accumulator -= SIM_STEP
+            steps += 1
+
+            # Check player health
+            if player_health <= 0:
+                if not game_over():
+                    running = False
+                elif recorder:
+                    recorder.restarted()
+                presenter.invalidate()
+                previous_view = current_view = (player_x, player_y, player_angle)
+                accumulator = 0.0
+                break
+
+        # Too far behind: drop the backlog instead of spiralling
+        if steps == MAX_SIM_STEPS:
+            accumulator = min(accumulator, SIM_STEP)
+
+        # Draw everything between the last two ticks
+        alpha = accumulator / SIM_STEP
+        view_x, view_y, view_angle = interpolate_view(previous_view, current_view, alpha)
+        rendered = presenter.draw(view_x, view_y, view_angle, alpha)
 
 # Start the game
 def start_menu():
@@ -989,6 +3265,8 @@ def start_menu():
                 pygame.quit()
                 sys.exit()
             elif event.type == pygame.KEYDOWN:
+                # Starting before loading finishes is fine; the game loads
+                # what it still needs on first use
                 if event.key == pygame.K_RETURN:
                     return True
                 elif event.key == pygame.K_ESCAPE:
@@ -1001,20 +3279,331 @@ def start_menu():
         screen.blit(start_text, (WIDTH // 2 - start_text.get_width() // 2, HEIGHT // 2))
         screen.blit(controls_text, (WIDTH // 2 - controls_text.get_width() // 2, HEIGHT // 2 + 50))
         screen.blit(controls_text2, (WIDTH // 2 - controls_text2.get_width() // 2, HEIGHT // 2 + 80))
+
+        # Asset loading progress
+        loaded, total = assets.progress()
+        if loaded < total:
+            bar = pygame.Rect(WIDTH // 2 - 150, HEIGHT - 80, 300, 12)
+            pygame.draw.rect(screen, GRAY, bar, 1)
+            pygame.draw.rect(screen, WHITE, (bar.x, bar.y, bar.width * loaded // total, bar.height))
+            loading_text = start_font.render(f"Loading assets {loaded}/{total}", True, GRAY)
+            screen.blit(loading_text, (WIDTH // 2 - loading_text.get_width() // 2, bar.y - 35))
         
         pygame.display.flip()
         clock.tick(60)
     
     return False
     
-# Set mouse to center and hide cursor
-pygame.mouse.set_pos(WIDTH // 2, HEIGHT // 2)
-pygame.mouse.set_visible(False)
+# Stages timed by the benchmark, wrapped by name in the module namespace
+BENCHMARK_STAGES = ["draw_scene", "cast_rays", "cast_ray", "project_sprites", "draw_sprites", "draw_minimap", "draw_hud"]
+
+# Per-frame timings of named stages; nested stages are timed inclusively
+class StageTimer:
+    def __init__(self, names):
+        self.names = list(names)
+        self.current = {}
+        self.samples = {name: [] for name in self.names}
+
+    def wrap(self, name, func):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(name, time.perf_counter() - start)
+        return timed
+
+    def add(self, name, seconds):
+        self.current[name] = self.current.get(name, 0.0) + seconds
+
+    def end_frame(self, record=True):
+        if record:
+            for name in self.names:
+                self.samples[name].append(self.current.get(name, 0.0) * 1000)
+        self.current = {}
 
-# Run the game
-if start_menu():
-    main_game()
+    def summary(self):
+        summary = {}
+        for name in self.names:
+            values = np.array(self.samples[name])
+            if values.size == 0:
+                continue
+            summary[name] = {
+                "mean_ms": float(values.mean()),
+                "p50_ms": float(np.percentile(values, 50)),
+                "p90_ms": float(np.percentile(values, 90)),
+                "p99_ms": float(np.percentile(values, 99)),
+                "max_ms": float(values.max()),
+            }
+        return summary
+
+# Deterministic camera path for the benchmark: walk forward, turn away from
+# walls by a seeded random angle and sweep the view slowly left and right
+def benchmark_camera_path(frames, seed):
+    rng = random.Random(seed)
+    x, y, heading = player_x, player_y, 0.0
+    path = []
+    for frame in range(frames):
+        dir_x, dir_y = heading_vector(heading)
+        dx = dir_x * player_speed
+        dy = dir_y * player_speed
+        if is_wall(x + dx * 8, y + dy * 8):
+            heading = (heading + rng.uniform(90, 270)) % 360
+        else:
+            x += dx
+            y += dy
+        path.append((x, y, (heading + 20 * math.sin(frame / 30)) % 360))
+    return path
+
+# Replay the camera path headlessly and report per-stage frame timings
+def run_benchmark(frames=600, warmup=30, seed=0, json_path=None):
+    global player_x, player_y, player_angle
+
+    start_session(seed)
+    path = benchmark_camera_path(warmup + frames, seed)
+
+    timer = StageTimer(["frame"] + BENCHMARK_STAGES + ["enemy_update"])
+    originals = {name: globals()[name] for name in BENCHMARK_STAGES}
+    for name, func in originals.items():
+        globals()[name] = timer.wrap(name, func)
+
+    try:
+        for frame, (player_x, player_y, player_angle) in enumerate(path):
+            frame_start = time.perf_counter()
+
+            start = time.perf_counter()
+            update_enemies(player_x, player_y)
+            timer.add("enemy_update", time.perf_counter() - start)
+            update_doors()
+
+            screen.fill(BLACK)
+            draw_scene(player_x, player_y, player_angle)
+            draw_weapon()
+            draw_hud()
+            draw_minimap(player_x, player_y, player_angle)
+            pygame.display.flip()
+
+            timer.add("frame", time.perf_counter() - frame_start)
+            timer.end_frame(record=frame >= warmup)
+    finally:
+        globals().update(originals)
+
+    report = {
+        "frames": frames,
+        "warmup": warmup,
+        "seed": seed,
+        "resolution": [WIDTH, HEIGHT],
+        "ray_count": ray_count,
+        "python": platform.python_version(),
+        "pygame": pygame.version.ver,
+        "numpy": np.__version__,
+        "column_cache": column_cache.stats(),
+        "assets": assets.report,
+        "stages": timer.summary(),
+    }
+
+    if json_path == "-":
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"{'stage':<22}{'mean':>8}{'p50':>8}{'p90':>8}{'p99':>8}{'max':>8}  (ms, {frames} frames)")
+        for name, stats in report["stages"].items():
+            print(f"{name:<22}{stats['mean_ms']:>8.2f}{stats['p50_ms']:>8.2f}{stats['p90_ms']:>8.2f}"
+                  f"{stats['p99_ms']:>8.2f}{stats['max_ms']:>8.2f}")
+        if json_path:
+            with open(json_path, "w") as f:
+                json.dump(report, f, indent=2)
+    return report
+
+def print_simulation_report(report, json_path=None):
+    if json_path == "-":
+        print(json.dumps(report, indent=2))
+        return
+    print(f"{report['ticks']} ticks in {report['seconds']:.3f} s: {report['ticks_per_second']:.0f} ticks/s "
+          f"({report['realtime_factor']:.1f}x real time)")
+    print(f"deaths {report['deaths']}, kills {report['kills']}, final health {report['player_health']}")
+    if json_path:
+        with open(json_path, "w") as f:
+            json.dump(report, f, indent=2)
+
+# Print how long each asset took to load and why any fell back
+def print_asset_report():
+    print(f"{'asset':<18}{'ms':>8}  {'source':<9} reason")
+    for name, entry in assets.report.items():
+        print(f"{name:<18}{entry['seconds'] * 1000:>8.2f}  {entry['source']:<9} {entry['reason'] or ''}")
+
+# Checks of the determinism recordings and simulations rely on, run by
+# --selftest on the current level. Each returns None if it passed, or what
+# went wrong.
+SELFTEST_TICKS = 600  # Ticks of scripted play per check
+SELFTEST_WORLDS = 8  # Worlds in the batch check
+
+# A scripted session recorded to a file replays with matching state hashes,
+# and a replay notices a hash that does not match
+def check_replay(ticks=SELFTEST_TICKS, seed=0):
+    start_session(seed)
+    recorder = InputRecorder(seed)
+    for tick in itertools.islice(soak_inputs(seed), ticks):
+        simulate_tick(tick)
+        recorder.record(tick)
+        if player_health <= 0:
+            restart_game()
+            recorder.restarted()
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "selftest.drec")
+        recorder.save(path)
+        if not run_replay(path):
+            return "the replay diverged from the recording"
+        buttons, weapon, mouse_turn, digest = recorder.rows[ticks // 2]
+        recorder.rows[ticks // 2] = (buttons, weapon, mouse_turn, digest ^ 1)
+        recorder.save(path)
+        if run_replay(path):
+            return "the replay missed a changed state hash"
+    return None
+
+# Two simulations from the same seed pass through the same states
+def check_simulation(ticks=SELFTEST_TICKS, seed=0):
+    runs = []
+    for _ in range(2):
+        hashes = []  # Taken as each tick's input is read, so before the tick
+        report = run_simulation(ticks, (hashes.append(state_hash()) or tick for tick in soak_inputs(seed)), seed)
+        runs.append((report["deaths"], report["kills"], rng.getstate(), hashes + [state_hash()]))
+    for tick, (first, second) in enumerate(zip(runs[0][3], runs[1][3])):
+        if first != second:
+            return f"the runs diverged before tick {tick}"
+    if runs[0] != runs[1]:
+        return "the runs ended differently"
+    return None
+
+# A WorldBatch steps its worlds exactly like Worlds stepped on their own.
+# Each tick a world takes either the scripted player's input, to get around
+# the level, or random input that also switches weapons and restarts.
+def check_batch(ticks=SELFTEST_TICKS, seed=0, count=SELFTEST_WORLDS):
+    start_session(seed)
+    level = Level(MAP.copy(), PLAYER_START, ENEMY_SPAWNS, pvs.table)
+    batch = WorldBatch(count, level, seed)
+    worlds = [World(level._replace(grid=level.grid.copy()), seed + index) for index in range(count)]
+    scripts = [soak_inputs(seed + index) for index in range(count)]
+    input_rng = np.random.default_rng(seed)
+    restart = 1 << REPLAY_BUTTONS.index("restart")
+    for tick in range(ticks):
+        rows = np.zeros(count, dtype=INPUT_ROW)
+        rows["buttons"] = input_rng.integers(0, restart, count) | np.where(input_rng.random(count) < 0.01, restart, 0)
+        rows["weapon"] = np.where(input_rng.random(count) < 0.05, input_rng.integers(1, len(WEAPONS), count), 0)
+        rows["mouse_turn"] = input_rng.normal(0, 5, count)
+        for index in np.flatnonzero(input_rng.random(count) < 0.6).tolist():
+            with worlds[index]:
+                rows[index] = tick_row(next(scripts[index]))
+        done = batch.step(rows)["done"]
+        batch.push()
+        for index, (world, batch_world, tick_input) in enumerate(zip(worlds, batch.worlds, recorded_inputs(rows))):
+            with world:
+                simulate_tick(tick_input)
+                died = player_health <= 0
+                if died:
+                    restart_game()
+                expected = state_hash()
+            with batch_world:
+                actual = state_hash()
+            if died != done[index] or actual != expected:
+                return f"world {index} of the batch diverged at tick {tick}"
+    return None
+
+SELFTESTS = (("replay", check_replay), ("simulation", check_simulation), ("batch", check_batch))
+
+# Run every check; returns True if all passed
+def run_selftest():
+    failed = 0
+    for name, check in SELFTESTS:
+        problem = check()
+        print(f"{name}: {problem or 'ok'}")
+        failed += problem is not None
+    return failed == 0
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="DOOM Clone")
+    parser.add_argument("--benchmark", action="store_true", help="run the headless frame benchmark and exit")
+    parser.add_argument("--frames", type=int, default=600, help="benchmark frames to record")
+    parser.add_argument("--warmup", type=int, default=30, help="benchmark frames to run before recording")
+    parser.add_argument("--seed", type=int, help="random seed for the benchmark (default 0) and recordings")
+    parser.add_argument("--json", metavar="PATH",
+                        help="write the benchmark or simulation report as JSON ('-' for stdout)")
+    parser.add_argument("--asset-cache", metavar="DIR", help="directory for cached generated assets")
+    parser.add_argument("--asset-report", action="store_true",
+                        help="load every asset, print per-asset load times and fallbacks, and exit")
+    parser.add_argument("--simulate", type=int, metavar="TICKS",
+                        help="run TICKS ticks of game logic headlessly with scripted input and exit")
+    parser.add_argument("--record", metavar="PATH", help="record the session's input to a file for --replay")
+    parser.add_argument("--replay", metavar="PATH", help="replay a recording headlessly and exit")
+    parser.add_argument("--selftest", action="store_true",
+                        help="check that replays and simulations are deterministic and exit")
+    parser.add_argument("--no-verify", action="store_true",
+                        help="replay without checking the state hash after every tick")
+    parser.add_argument("--map", metavar="PATH", help="level file to play (see save_level)")
+    parser.add_argument("--export-map", metavar="PATH", help="write the current level to a level file and exit")
+    parser.add_argument("--with-pvs", action="store_true", help="store the level's precomputed PVS with --export-map (levels up to 64x64 tiles)")
+    parser.add_argument("--full-redraw", action="store_true",
+                        help="redraw and present the whole screen every frame")
+    parser.add_argument("--fixed-resolution", action="store_true",
+                        help="always cast RAY_COUNT rays instead of adapting to frame time")
+    parser.add_argument("--render-threads", type=int, default=RENDER_THREADS,
+                        help="threads for the wall pass (0 or 1 renders on the main thread)")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    # The benchmark runs without a window or a sound card
+    if args.benchmark:
+        os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+        os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    if args.asset_cache:
+        assets.cache_dir = args.asset_cache
+    RENDER_THREADS = args.render_threads
+    DYNAMIC_RESOLUTION = not args.fixed_resolution
+    DIRTY_RECTS = not args.full_redraw
+    if args.map:
+        set_level(load_level(args.map))
+    if args.export_map:
+        if args.with_pvs and MAP.size > PVS_EXPORT_TILES:
+            sys.exit(f"--with-pvs: a {MAP.shape[1]}x{MAP.shape[0]} level is too large to precompute its PVS "
+                     f"(limit {PVS_EXPORT_TILES} tiles); export it without one")
+        save_level(args.export_map, MAP, PLAYER_START, ENEMY_SPAWNS, pvs.table if args.with_pvs else None)
+        sys.exit()
+
+    # Simulations and replays step the game logic only: no display, no sound
+    if args.simulate is not None:
+        print_simulation_report(run_simulation(args.simulate, seed=args.seed or 0), args.json)
+        sys.exit()
+    if args.replay:
+        sys.exit(0 if run_replay(args.replay, verify=not args.no_verify) else 1)
+    if args.selftest:
+        sys.exit(0 if run_selftest() else 1)
+    init_display()
+
+    if args.asset_report:
+        assets.preload_all()
+        print_asset_report()
+    elif args.benchmark:
+        run_benchmark(args.frames, args.warmup, args.seed or 0, args.json)
+    else:
+        # Load assets in the background while the start menu is up
+        assets.preload()
+
+        # Set mouse to center and hide cursor
+        pygame.mouse.set_pos(WIDTH // 2, HEIGHT // 2)
+        pygame.mouse.set_visible(False)
+
+        # Run the game, recording its input if asked
+        if start_menu():
+            seed = args.seed if args.seed is not None else random.randrange(2 ** 32)
+            start_session(seed)
+            recorder = InputRecorder(seed) if args.record else None
+            try:
+                main_game(recorder)
+            finally:
+                if recorder:
+                    recorder.save(args.record)
 
-# Quit pygame
-pygame.quit()
-sys.exit()
\ No newline at end of file
+    # Quit pygame
+    pygame.quit()
+    sys.exit()